@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Concurrency benchmark for v20fix.py's update processor.
+
+Feeds synthetic updates from many users through PerUserUpdateProcessor the way
+the Application does (one task per fetched update) with handlers that wait on
+simulated Bot API calls, and reports throughput and latency per max-in-flight
+setting. Also checks that every user's updates finished in arrival order.
+
+    python bench/concurrency_bench.py
+    python bench/concurrency_bench.py --users 500 --per-user 10 --levels 1,8,64,256
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Update  # noqa: E402
+
+from locks import PerUserUpdateProcessor  # noqa: E402
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+            "text": "/start",
+        },
+    }, None)
+
+
+async def run(level: int, updates, latency: float, slow_ratio: float, slow_latency: float, seed: int):
+    rng = random.Random(seed)
+    delays = [slow_latency if rng.random() < slow_ratio else rng.uniform(0.5, 1.5) * latency for _ in updates]
+    finished = {}
+    waits = []
+    proc = PerUserUpdateProcessor(level)
+
+    async def handler(i: int, update: Update, queued: float):
+        waits.append(time.perf_counter() - queued)
+        await asyncio.sleep(delays[i])  # get_chat_member / send_message round trip
+        finished.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    t0 = time.perf_counter()
+    tasks = [asyncio.create_task(proc.process_update(u, handler(i, u, time.perf_counter())))
+             for i, u in enumerate(updates)]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - t0
+    out_of_order = sum(1 for ids in finished.values() if ids != sorted(ids))
+    waits.sort()
+    p50 = waits[len(waits) // 2]
+    p99 = waits[int(len(waits) * 0.99)]
+    print(f"{level:>6} {len(updates) / elapsed:>10.1f} {p50 * 1000:>12.0f} {p99 * 1000:>12.0f} {out_of_order:>8}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--per-user", type=int, default=3, help="updates per user (interleaved)")
+    ap.add_argument("--latency", type=float, default=0.05, help="mean handler time (s)")
+    ap.add_argument("--slow-ratio", type=float, default=0.02, help="share of slow handlers (e.g. send_photo)")
+    ap.add_argument("--slow-latency", type=float, default=1.0)
+    ap.add_argument("--levels", default="1,4,16,64,256")
+    args = ap.parse_args()
+
+    order = [uid for _ in range(args.per_user) for uid in range(1, args.users + 1)]
+    updates = [make_update(i + 1, uid) for i, uid in enumerate(order)]
+    print(f"{len(updates)} updates from {args.users} users, "
+          f"handler ~{args.latency * 1000:.0f}ms ({args.slow_ratio:.0%} take {args.slow_latency:.1f}s)")
+    print(f"{'level':>6} {'updates/s':>10} {'wait p50 ms':>12} {'wait p99 ms':>12} {'disorder':>8}")
+    for level in (int(x) for x in args.levels.split(",")):
+        asyncio.run(run(level, updates, args.latency, args.slow_ratio, args.slow_latency, seed=0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Offline stand-in for the Telegram Bot API, for load testing v20fix.py.
+
+Speaks enough of the HTTP protocol for `Application.builder().base_url(...)`:
+getMe, getUpdates (long polling), sendMessage, editMessageText,
+answerCallbackQuery, getChatMember, sendPhoto, copyMessage, deleteWebhook /
+setWebhook. Every call can be slowed down (latency) or answered with a 429
+(RetryAfter) or a 500, and `--flood-limits` enforces Telegram's own send limits
+(30/s overall, 1/s per private chat, 20/min per group) with real 429s.
+
+Traffic comes from the built-in generator (`--users`, `--rate`) and/or
+POST /_inject with one update or a list of them. GET /_stats returns call
+counts and the bot's response time: from handing out an update in getUpdates
+to the first call answering it (answerCallbackQuery for callback queries, the
+first send/edit into the chat otherwise).
+
+    python bench/fake_botapi.py --port 8081 --users 2000 --rate 300 --duration 60
+    WCOIN_API_URL=http://127.0.0.1:8081 BOT_TOKEN=1:fake python v20fix.py
+
+aiohttp is required: `pip install aiohttp`.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+STR_FIELDS = {"text", "caption", "callback_query_id", "photo", "url", "secret_token", "parse_mode"}
+SEND_METHODS = {"sendMessage", "sendPhoto", "copyMessage", "editMessageText"}
+USER_ACTIONS = ["balance", "machines", "buy_machine", "invite", "withdraw", "catalog:2", "owned:1"]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.5, rate_429: float = 0.0, retry_after: int = 1,
+                 fail: float = 0.0, blocked: float = 0.0, not_joined: float = 0.0, flood_limits: bool = False,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.fail = fail
+        self.blocked = blocked
+        self.not_joined = not_joined
+        self.flood_limits = flood_limits
+        self.rng = random.Random(seed)
+        self.updates: Deque[Dict[str, Any]] = deque()
+        self.new_updates = asyncio.Condition()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.delivered = 0
+        self.started = time.time()
+        # response time bookkeeping
+        self.pending_queries: Dict[str, float] = {}  # callback query id -> handed out at
+        self.pending_chats: Dict[int, Deque[float]] = {}  # chat id -> message updates handed out at
+        self.latencies: List[float] = []
+        # flood limits
+        self.sent_global: Deque[float] = deque()
+        self.chat_next: Dict[Any, float] = {}
+
+    # ---- updates ----
+
+    def inject(self, update: Dict[str, Any]):
+        update = dict(update)
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+
+    async def notify(self):
+        async with self.new_updates:
+            self.new_updates.notify_all()
+
+    def message_update(self, user_id: int, text: str) -> Dict[str, Any]:
+        msg = {"message_id": self._message_id(), "date": int(time.time()),
+               "chat": {"id": user_id, "type": "private"},
+               "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"u{user_id}"},
+               "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": msg}
+
+    def callback_update(self, user_id: int, data: str) -> Dict[str, Any]:
+        user = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"u{user_id}"}
+        message_id = self._message_id()
+        return {"callback_query": {
+            "id": f"{user_id}-{message_id}", "from": user, "chat_instance": str(user_id), "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                        "chat": {"id": user_id, "type": "private"}, "text": "Main Menu"}}}
+
+    async def generate(self, users: int, rate: float, duration: float):
+        """Synthetic traffic: each user's first update is /start, then menu clicks."""
+        started = set()
+        deadline = time.monotonic() + duration
+        tick = 0.01
+        owed = 0.0
+        while time.monotonic() < deadline:
+            owed += rate * tick
+            while owed >= 1:
+                owed -= 1
+                uid = 1000 + self.rng.randrange(users)
+                if uid not in started:
+                    started.add(uid)
+                    self.inject(self.message_update(uid, "/start"))
+                else:
+                    self.inject(self.callback_update(uid, self.rng.choice(USER_ACTIONS)))
+            await self.notify()
+            await asyncio.sleep(tick)
+
+    async def get_updates(self, p: Dict[str, Any]):
+        offset = int(p.get("offset") or 0)
+        limit = int(p.get("limit") or 100)
+        timeout = float(p.get("timeout") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()  # confirmed by the offset
+        if not self.updates and timeout:
+            async with self.new_updates:
+                try:
+                    await asyncio.wait_for(self.new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        batch = list(self.updates)[:limit]
+        now = time.perf_counter()
+        for u in batch:
+            if u.get("_handed_out"):
+                continue  # redelivered: the bot did not confirm it yet
+            u["_handed_out"] = True
+            self.delivered += 1
+            if "callback_query" in u:
+                self.pending_queries[u["callback_query"]["id"]] = now
+            elif "message" in u:
+                self.pending_chats.setdefault(u["message"]["chat"]["id"], deque()).append(now)
+        return [{k: v for k, v in u.items() if k != "_handed_out"} for u in batch]
+
+    def answered_chat(self, chat_id):
+        pending = self.pending_chats.get(chat_id)
+        if pending:
+            self.latencies.append(time.perf_counter() - pending.popleft())
+            if not pending:
+                del self.pending_chats[chat_id]
+
+    # ---- methods ----
+
+    def _message_id(self) -> int:
+        self.next_message_id += 1
+        return self.next_message_id
+
+    def _message(self, chat_id, **extra) -> Dict[str, Any]:
+        if isinstance(chat_id, int):
+            chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        else:  # @channel
+            chat = {"id": -1001000000000 - len(str(chat_id)), "type": "channel", "username": str(chat_id).lstrip("@")}
+        return {"message_id": self._message_id(), "date": int(time.time()), "chat": chat, "from": BOT_USER, **extra}
+
+    def _is_blocked(self, chat_id) -> bool:
+        return isinstance(chat_id, int) and chat_id > 0 and random.Random(chat_id).random() < self.blocked
+
+    async def call(self, method: str, p: Dict[str, Any]):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return await self.get_updates(p)
+        if method in ("deleteWebhook", "setWebhook", "setMyCommands"):
+            return True
+        if method == "getChatMember":
+            joined = random.Random(hash((p.get("chat_id"), p.get("user_id")))).random() >= self.not_joined
+            return {"status": "member" if joined else "left",
+                    "user": {"id": int(p["user_id"]), "is_bot": False, "first_name": "u"}}
+        if method == "answerCallbackQuery":
+            at = self.pending_queries.pop(p.get("callback_query_id"), None)
+            if at is not None:
+                self.latencies.append(time.perf_counter() - at)
+            return True
+        chat_id = p.get("chat_id")
+        if method in SEND_METHODS and self._is_blocked(chat_id):
+            raise ApiError(403, "Forbidden: bot was blocked by the user")
+        if method == "sendMessage":
+            self.answered_chat(chat_id)
+            return self._message(chat_id, text=p.get("text", ""))
+        if method == "editMessageText":
+            if "inline_message_id" in p:
+                return True
+            self.answered_chat(chat_id)
+            return {**self._message(chat_id, text=p.get("text", "")), "message_id": int(p["message_id"])}
+        if method == "sendPhoto":
+            self.answered_chat(chat_id)
+            photo = str(p.get("photo") or "uploaded")
+            return self._message(chat_id, caption=p.get("caption"), photo=[
+                {"file_id": photo, "file_unique_id": photo[:16], "width": 800, "height": 600}])
+        if method == "copyMessage":
+            self.answered_chat(chat_id)
+            return {"message_id": self._message_id()}
+        raise ApiError(404, "Not Found: method not found")
+
+    def _throttle(self, chat_id) -> Optional[int]:
+        """Seconds to wait if this send breaks Telegram's flood limits (--flood-limits)."""
+        now = time.monotonic()
+        while self.sent_global and now - self.sent_global[0] >= 1:
+            self.sent_global.popleft()
+        if len(self.sent_global) >= 30:
+            return 1
+        interval = 1.0 if isinstance(chat_id, int) and chat_id > 0 else 3.0
+        if self.chat_next.get(chat_id, 0) > now:
+            return max(1, int(self.chat_next[chat_id] - now + 0.999))
+        self.chat_next[chat_id] = now + interval
+        self.sent_global.append(now)
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        p = await read_params(request)
+        self.calls[method] += 1
+        if method != "getUpdates":
+            if self.latency:
+                await asyncio.sleep(self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+            if self.rng.random() < self.fail:
+                return self._error(method, 500, "Internal Server Error")
+            if method in SEND_METHODS:
+                wait = self._throttle(p.get("chat_id")) if self.flood_limits else None
+                if wait is None and self.rng.random() < self.rate_429:
+                    wait = self.retry_after
+                if wait is not None:
+                    return self._error(method, 429, f"Too Many Requests: retry after {wait}", retry_after=wait)
+        try:
+            result = await self.call(method, p)
+        except ApiError as e:
+            return self._error(method, e.code, e.description)
+        return web.json_response({"ok": True, "result": result})
+
+    def _error(self, method: str, code: int, description: str, retry_after: Optional[int] = None) -> web.Response:
+        self.errors[(method, code)] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if retry_after is not None:
+            body["parameters"] = {"retry_after": retry_after}
+        return web.json_response(body, status=code)
+
+    # ---- control ----
+
+    async def handle_inject(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        for update in body if isinstance(body, list) else [body]:
+            self.inject(update)
+        await self.notify()
+        return web.json_response({"queued": len(self.updates)})
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = time.time() - self.started
+        ms = lambda v: None if v is None else round(v * 1000, 1)  # noqa: E731
+        return {
+            "elapsed": round(elapsed, 1),
+            "updates_delivered": self.delivered,
+            "updates_queued": len(self.updates),
+            "answered": len(self.latencies),
+            "answered_per_sec": round(len(self.latencies) / max(elapsed, 1e-6), 1),
+            "response_ms": {"p50": ms(percentile(self.latencies, 0.5)), "p95": ms(percentile(self.latencies, 0.95)),
+                            "p99": ms(percentile(self.latencies, 0.99))},
+            "calls": dict(self.calls),
+            "errors": {f"{m} {code}": n for (m, code), n in self.errors.items()},
+        }
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_post("/_inject", self.handle_inject)
+        app.router.add_get("/_stats", self.handle_stats)
+        return app
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+
+
+async def read_params(request: web.Request) -> Dict[str, Any]:
+    """Bot API parameters: query string plus a form / multipart / JSON body; non-string values are JSON."""
+    raw: Dict[str, Any] = dict(request.query)
+    if request.content_type == "application/json":
+        raw.update(await request.json())
+        return raw
+    if request.can_read_body:
+        form = await request.post()
+        for k, v in form.items():
+            raw[k] = v if isinstance(v, str) else f"upload:{getattr(v, 'filename', k)}"
+    params = {}
+    for k, v in raw.items():
+        if k in STR_FIELDS or not isinstance(v, str):
+            params[k] = v
+            continue
+        try:
+            params[k] = json.loads(v)
+        except ValueError:
+            params[k] = v  # e.g. chat_id "@channel"
+    return params
+
+
+async def run(args):
+    api = FakeBotAPI(latency=args.latency, rate_429=args.rate_429, retry_after=args.retry_after, fail=args.fail,
+                     blocked=args.blocked, not_joined=args.not_joined, flood_limits=args.flood_limits, seed=args.seed)
+    runner = web.AppRunner(api.build_app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Fake Bot API on http://{args.host}:{args.port} (base_url http://{args.host}:{args.port}/bot)")
+    try:
+        if args.users and args.rate:
+            await api.generate(args.users, args.rate, args.duration)
+            await asyncio.sleep(args.drain)
+            print(json.dumps(api.stats(), indent=2))
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="mean seconds per API call (+-50%%)")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="share of sends answered with 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--fail", type=float, default=0.0, help="share of calls answered with 500")
+    ap.add_argument("--blocked", type=float, default=0.0, help="share of users that blocked the bot (403)")
+    ap.add_argument("--not-joined", type=float, default=0.0, help="share of users not in the required channels")
+    ap.add_argument("--flood-limits", action="store_true", help="enforce Telegram's send limits with 429s")
+    ap.add_argument("--users", type=int, default=0, help="synthetic users (0 = only /_inject)")
+    ap.add_argument("--rate", type=float, default=100.0, help="synthetic updates per second")
+    ap.add_argument("--duration", type=float, default=30.0)
+    ap.add_argument("--drain", type=float, default=5.0, help="seconds to wait for answers after the last update")
+    ap.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for v20fix.py user records: plain dicts vs models.User.
+
+Builds N users both ways (the same records ensure_user / install_machine
+create) and reports the traced bytes per user and the time to build them
+from stored dicts, which is what load_state() pays at boot.
+
+    python bench/memory_bench.py
+    python bench/memory_bench.py --users 1000000 --machines 0,1,3
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from models import User  # noqa: E402
+
+
+def make_record(uid: int, machines: int, now: int):
+    return {
+        "id": uid,
+        "username": f"user{uid}",
+        "balance": uid % 100000,
+        "referrals": uid % 7,
+        "referred_by": None,
+        "referral_credited": True,
+        "machines": [{"machine_no": no, "buy_ts": now, "expire_ts": now + 30 * 86400, "last_claim_ts": now,
+                      "method": "wave"} for no in range(1, machines + 1)],
+        "withdraw_account": "09123456789",
+        "withdraw_fail_count": 0,
+        "awaiting": None,
+        "pending_order": None,
+        "skip_verified": False,
+    }
+
+
+def build(users: int, machines: int, compact: bool):
+    now = int(time.time())
+    if compact:
+        return {uid: User.from_dict(make_record(uid, machines, now)) for uid in range(users)}
+    return {uid: make_record(uid, machines, now) for uid in range(users)}
+
+
+def measure(users: int, machines: int, compact: bool):
+    """(bytes per user, seconds to build) - timed without tracemalloc, which slows allocation down."""
+    gc.collect()
+    t0 = time.perf_counter()
+    table = build(users, machines, compact)
+    elapsed = time.perf_counter() - t0
+    del table
+    gc.collect()
+    tracemalloc.start()
+    table = build(users, machines, compact)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del table
+    return size / users, elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=200000)
+    ap.add_argument("--machines", default="0,1,3", help="machines per user, comma-separated")
+    args = ap.parse_args()
+    print(f"{args.users} users (bytes include the USERS dict slot and the username string)")
+    print(f"{'machines':>8} {'dict B/user':>12} {'User B/user':>12} {'saved':>7} {'dict s':>7} {'User s':>7}")
+    for n in (int(x) for x in args.machines.split(",")):
+        plain, t_plain = measure(args.users, n, compact=False)
+        compact, t_compact = measure(args.users, n, compact=True)
+        print(f"{n:>8} {plain:>12.0f} {compact:>12.0f} {1 - compact / plain:>7.0%} {t_plain:>7.2f} {t_compact:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Update replay benchmark for v20fix.py: the regression baseline for handler cost.
+
+Loads N synthetic users, generates a realistic update stream and feeds it
+through Application.process_update() of the Application main() builds (same
+handlers, same dispatch). Bot API calls are answered in-process by
+bench/fake_botapi.py's FakeBotAPI, so the numbers are handler + PTB cost only:
+no network, and no outbound limiter unless --rate-limit is given.
+
+Stream (per-step labels in the report):
+- start_ref: a new user opens a /start <referrer> deep link
+- menu: main-menu and page callbacks
+- claim: claim spam on machine 1, which every seeded user owns (three
+  times, then Claim all); about half the users are ready to claim
+- buy: callback, transfer number, payment screenshot
+- admin: /Wreq_C <order> and the receipt photo
+
+Each user count runs in a fresh process, so the peak RSS is that of one bot.
+
+    python bench/replay_bench.py
+    python bench/replay_bench.py --users 1000,100000,1000000 --updates 50000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ADMIN_ID = 42
+os.environ.setdefault("BOT_TOKEN", "1:replay")
+os.environ["WCOIN_ADMINS"] = str(ADMIN_ID)
+os.environ.pop("WCOIN_DB", None)  # in-memory store: persistence has its own benchmark
+
+from telegram import Update  # noqa: E402
+from telegram.ext import BaseRateLimiter  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+from fake_botapi import FakeBotAPI, ApiError, percentile  # noqa: E402
+
+MENU = ["balance", "machines", "buy_machine", "invite", "withdraw", "catalog:2", "owned:1"]
+STEPS = [("start_ref", 5), ("menu", 45), ("claim", 25), ("buy", 15), ("admin", 5)]
+
+
+class NoLimit(BaseRateLimiter):
+    """Pass-through limiter: accepts the bot's rate_limit_args but never waits."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        return await callback(*args, **kwargs)
+
+
+class LocalRequest(BaseRequest):
+    """Answers Bot API requests in-process with FakeBotAPI (no sockets, no JSON over HTTP)."""
+
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        params = request_data.parameters if request_data else {}
+        try:
+            result = await self.api.call(url.rsplit("/", 1)[1], params)
+        except ApiError as e:
+            return e.code, json.dumps({"ok": False, "error_code": e.code, "description": e.description}).encode()
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_user(uid: int, now: int, rng: random.Random):
+    return {
+        "id": uid,
+        "username": f"user{uid}",
+        "balance": rng.randint(0, 200000),
+        "referrals": rng.randint(0, 20),
+        "referred_by": None,
+        "referral_credited": True,
+        # last claim 0-24h ago with a 12h interval: about half the users can claim machine 1 right away
+        "machines": [{"machine_no": 1, "buy_ts": now - 86400, "expire_ts": now + 29 * 86400,
+                      "last_claim_ts": now - rng.randint(0, 86400), "method": "wave"}],
+        "withdraw_account": "09123456789",
+        "withdraw_fail_count": 0,
+        "awaiting": None,
+        "pending_order": None,
+        "skip_verified": False,
+    }
+
+
+class Stream:
+    """Builds update dicts the way Telegram sends them."""
+
+    def __init__(self, api: FakeBotAPI, users: int, rng: random.Random):
+        self.api = api
+        self.users = users
+        self.rng = rng
+        self.new_user = 10 ** 9
+        self.orders = []
+
+    def user(self) -> int:
+        return 1000 + self.rng.randrange(self.users)
+
+    def photo(self, uid: int):
+        u = self.api.message_update(uid, "")
+        msg = u["message"]
+        del msg["text"]
+        msg["photo"] = [{"file_id": f"photo{msg['message_id']}", "file_unique_id": f"p{msg['message_id']}",
+                         "width": 800, "height": 600}]
+        return u
+
+    def step(self, kind: str):
+        """[(label, update dict), ...] for one user action."""
+        api = self.api
+        if kind == "start_ref":
+            self.new_user += 1
+            return [(kind, api.message_update(self.new_user, f"/start {self.user()}"))]
+        if kind == "menu":
+            return [(kind, api.callback_update(self.user(), self.rng.choice(MENU)))]
+        if kind == "claim":
+            uid = self.user()
+            # claim::<machine_no>: a real claim when ready, then the remaining-time answer
+            return [("claim", api.callback_update(uid, "claim::1")) for _ in range(3)] + [
+                ("claim", api.callback_update(uid, "claim_all"))]
+        if kind == "buy":
+            uid = self.user()
+            return [("buy", api.callback_update(uid, f"buy_{self.rng.choice([1, 2, 3])}")),
+                    ("buy", api.message_update(uid, str(self.rng.randrange(10 ** 11, 10 ** 12)))),
+                    ("buy", self.photo(uid))]
+        if kind == "admin":
+            oid = self.orders.pop()
+            return [("admin", api.message_update(ADMIN_ID, f"/Wreq_C {oid}")), ("admin", self.photo(ADMIN_ID))]
+        raise ValueError(kind)
+
+
+async def run(users: int, updates: int, rate_limit: bool, seed: int):
+    import v20fix
+
+    rng = random.Random(seed)
+    now = int(time.time())
+    t0 = time.perf_counter()
+    # the in-memory store yields the seeded users to load_state() like a real backend would
+    v20fix.STORE.load_users = lambda: (make_user(uid, now, rng) for uid in range(1000, 1000 + users))
+    v20fix.load_state()
+    load_time = time.perf_counter() - t0
+
+    api = FakeBotAPI(seed=seed)
+    stream = Stream(api, users, rng)
+    kinds, weights = zip(*STEPS)
+    plan = []
+    while len(plan) < updates:
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "admin":  # one pending withdraw order per receipt
+            uid = stream.user()
+            oid = v20fix.next_order_id()
+            v20fix.WITHDRAW_REQUESTS.add({"order_id": oid, "user_id": uid, "amount": 50000, "account": "09",
+                                          "created_at": "2025-01-01T00:00:00"})
+            stream.orders.append(oid)
+        plan.extend(stream.step(kind))
+
+    builder = v20fix.Application.builder().request(LocalRequest(api)).updater(None)
+    application = v20fix.build_application(builder, rate_limiter=None if rate_limit else NoLimit())
+    await application.initialize()
+    v20fix.WRITER.start()
+    decoded = [(label, Update.de_json({"update_id": i + 1, **u}, application.bot)) for i, (label, u) in enumerate(plan)]
+
+    times = {}
+    t0 = time.perf_counter()
+    for label, update in decoded:
+        t = time.perf_counter()
+        await application.process_update(update)
+        times.setdefault(label, []).append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - t0
+    await v20fix.WRITER.stop()
+    await application.shutdown()
+
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"users={users}  load {load_time:.1f}s  {len(decoded)} updates in {elapsed:.2f}s "
+          f"= {len(decoded) / elapsed:.0f} upd/s  peak RSS {rss_mb:.0f} MB")
+    print(f"  {'handler':<10} {'n':>7} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9}")
+    for label, _ in STEPS:
+        ts = times.get(label, [])
+        if ts:
+            print(f"  {label:<10} {len(ts):>7} {percentile(ts, 0.5) * 1e6:>9.0f} "
+                  f"{percentile(ts, 0.95) * 1e6:>9.0f} {percentile(ts, 0.99) * 1e6:>9.0f}")
+    sys.stdout.flush()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", default="1000,100000", help="comma-separated user counts, e.g. 1000,100000,1000000")
+    ap.add_argument("--updates", type=int, default=20000)
+    ap.add_argument("--rate-limit", action="store_true", help="keep the outbound limiter (measures its waits too)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child is not None:
+        asyncio.run(run(args.child, args.updates, args.rate_limit, args.seed))
+        return
+    for n in (int(x) for x in args.users.split(",")):
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", str(n), "--updates", str(args.updates),
+               "--seed", str(args.seed)] + (["--rate-limit"] if args.rate_limit else [])
+        subprocess.run(cmd, check=True)
+
+
+if __name__ == "__main__":
+    main()
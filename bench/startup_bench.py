@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for v20fix.py persistence.
+
+Builds a store with N users (snapshot + a journal tail of M mutations), then
+measures how long a fresh process needs to open the store and run
+load_state(), i.e. the restart cost of main().
+
+    python bench/startup_bench.py --users 1000000 --journal 50000
+    python bench/startup_bench.py --backend sqlite --users 100000
+
+Exits non-zero when the best run misses the target: TARGET_BASE plus
+TARGET_PER_MILLION seconds per million users on the snapshot backend
+(--target overrides it).
+Most of a cold start is unpickling one User per user (~2 s per million);
+load_state's pass and the import add the rest, the admin-only indexes are
+built on first use.
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from storage import open_storage, MACHINE_ORDER  # noqa: E402
+from models import User  # noqa: E402
+
+# seconds, snapshot backend: 4.5 s at 1M users (best of 3 was 3.9 s on one vCPU, 1.75 s at 200k);
+# the base is the import plus replaying the journal tail
+TARGET_BASE = 1.5
+TARGET_PER_MILLION = 3.0
+
+
+def make_user(uid: int, now: int):
+    """A record as the bot stores it (User, as kept in USERS)."""
+    return User.from_dict({
+        "id": uid,
+        "username": f"user{uid}",
+        "balance": random.randint(0, 100000),
+        "referrals": random.randint(0, 20),
+        "referred_by": None,
+        "referral_credited": True,
+        "machines": [
+            {"machine_no": 1, "buy_ts": now, "expire_ts": now + 30 * 86400, "last_claim_ts": now, "method": "wave"}
+        ],
+        "withdraw_account": "09123456789",
+        "withdraw_fail_count": 0,
+        "awaiting": None,
+        "pending_order": None,
+        "skip_verified": False,
+    })
+
+
+def build(path: str, backend: str, users: int, journal: int, batch: int = 10000):
+    store = open_storage(path, backend)
+    now = int(time.time())
+    t0 = time.perf_counter()
+    for start in range(0, users, batch):
+        store.save_users(make_user(uid, now) for uid in range(start, min(start + batch, users)))
+    if backend == "snapshot":
+        store.compact(wait=True)  # everything so far goes into the snapshot
+    # journal tail: mutations since the snapshot, written as group commits
+    for start in range(0, journal, 1000):
+        store.save_users(make_user(random.randrange(users), now) for _ in range(min(1000, journal - start)))
+    store.save_orders(MACHINE_ORDER, [{"order_id": 1, "user_id": 1, "machine_no": 2}])
+    store.close()
+    print(f"built {users} users + {journal} journaled updates in {time.perf_counter() - t0:.1f}s")
+
+
+def measure(path: str, backend: str) -> float:
+    """Time open + load_state() of v20fix in a fresh interpreter."""
+    code = (
+        "import time, sys; t0 = time.perf_counter();"
+        f"sys.path.insert(0, {ROOT!r});"
+        "import v20fix; v20fix.load_state();"
+        "print(time.perf_counter() - t0, len(v20fix.USERS))"
+    )
+    env = dict(os.environ, BOT_TOKEN="0:bench", WCOIN_DB=path, WCOIN_BACKEND=backend)
+    env.pop("WCOIN_LEDGER", None)
+    out = subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                         capture_output=True, text=True).stdout.split()
+    print(f"startup: {float(out[0]):.2f}s for {out[1]} users")
+    return float(out[0])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=1000000)
+    ap.add_argument("--journal", type=int, default=50000, help="mutations written after the snapshot")
+    ap.add_argument("--backend", default="snapshot", choices=["snapshot", "sqlite"])
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--target", type=float, help="seconds; default TARGET_PER_MILLION scaled to --users "
+                                                 "(snapshot backend only)")
+    args = ap.parse_args()
+    target = args.target
+    if target is None and args.backend == "snapshot":
+        target = TARGET_BASE + TARGET_PER_MILLION * args.users / 1000000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "wcoin")
+        build(path, args.backend, args.users, args.journal)
+        times = [measure(path, args.backend) for _ in range(args.runs)]
+        print(f"best of {args.runs}: {min(times):.2f}s")
+    if target is not None:
+        if min(times) > target:
+            sys.exit(f"FAIL: startup {min(times):.2f}s is over the {target:.2f}s target")
+        print(f"ok: within the {target:.2f}s target")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Admin broadcast pipeline for the WCoin bot (v20fix.py).
+
+A broadcast walks the recipients in ascending user-id chunks and sends each
+chunk through a bounded pool of concurrent sends on the BULK lane of the
+outbound limiter, so it runs at the API ceiling while replies to users keep
+priority. After every chunk the job (message, cursor, counters) is written to a
+small JSON checkpoint; an interrupted broadcast resumes after the last finished
+chunk (at most one chunk can be delivered twice). Users that blocked the bot
+(Forbidden) are reported through `on_blocked` so the caller can prune them.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telegram.error import Forbidden, TelegramError
+
+from outbound import BULK
+
+logger = logging.getLogger(__name__)
+
+
+def new_job(text: Optional[str] = None, from_chat_id: Optional[int] = None,
+            message_id: Optional[int] = None, total: int = 0) -> Dict[str, Any]:
+    """Job state: either `text` or a message to copy (from_chat_id, message_id)."""
+    return {
+        "id": int(time.time()),
+        "text": text,
+        "from_chat_id": from_chat_id,
+        "message_id": message_id,
+        "cursor": 0,  # last user id of the last finished chunk
+        "total": total,
+        "sent": 0,
+        "blocked": 0,
+        "failed": 0,
+        "started": time.time(),
+        "finished": None,  # "done" / "stopped"
+        "status_chat": None,
+        "status_message": None,
+    }
+
+
+class Broadcaster:
+    def __init__(self, state_path: Optional[str], chunk_size: int = 500, concurrency: int = 30,
+                 progress_every: float = 3.0):
+        self.state_path = state_path
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.progress_every = progress_every
+        self.job: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    # ---- checkpoint ----
+
+    def load_unfinished(self) -> Optional[Dict[str, Any]]:
+        if not self.state_path:
+            return None
+        try:
+            with open(self.state_path, encoding="utf-8") as fh:
+                job = json.load(fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable broadcast checkpoint %s: %s", self.state_path, e)
+            return None
+        return None if job.get("finished") else job
+
+    def _save(self, job: Dict[str, Any]):
+        if not self.state_path:
+            return
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(job, fh, ensure_ascii=False)
+        os.replace(tmp, self.state_path)
+
+    # ---- running ----
+
+    def start(self, application, job: Dict[str, Any],
+              recipients: Callable[[int, int], List[int]],
+              on_blocked: Callable[[int], None],
+              on_progress: Callable[[Dict[str, Any]], Awaitable[None]]):
+        """
+        Run `job` in the background. recipients(after, limit) returns the next
+        user ids above `after` in ascending order, at most `limit` of them
+        (empty when finished). It is called per chunk, so it can page a store.
+        """
+        if self.running:
+            raise RuntimeError("A broadcast is already running")
+        self.job = job
+        self._stop = False
+        self._save(job)
+        # not application.create_task: Application.stop() would wait for the whole broadcast
+        self._task = asyncio.get_running_loop().create_task(
+            self._run(application.bot, job, recipients, on_blocked, on_progress))
+
+    def stop(self):
+        """Finish the current chunk and end the broadcast for good."""
+        self._stop = True
+
+    async def suspend(self):
+        """Interrupt the broadcast (bot shutdown); it resumes from its checkpoint on the next start."""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self, bot, job, recipients, on_blocked, on_progress):
+        sem = asyncio.Semaphore(self.concurrency)
+        reporter = asyncio.create_task(self._report(job, on_progress))
+        checkpoint = dict(job)  # counters must match the cursor, which only moves per chunk
+        try:
+            while not self._stop:
+                chunk = recipients(job["cursor"], self.chunk_size)
+                if not chunk:
+                    break
+                await asyncio.gather(*(self._send(bot, job, uid, sem, on_blocked) for uid in chunk))
+                job["cursor"] = chunk[-1]
+                checkpoint = dict(job)
+                self._save(checkpoint)
+            job["finished"] = "stopped" if self._stop else "done"
+        except Exception:
+            logger.exception("Broadcast %s aborted at user %s", job["id"], job["cursor"])
+            raise
+        finally:
+            reporter.cancel()
+            self._save(job if job["finished"] else checkpoint)
+        logger.info("Broadcast %s %s: sent=%d blocked=%d failed=%d", job["id"], job["finished"],
+                    job["sent"], job["blocked"], job["failed"])
+        try:
+            await on_progress(job)
+        except Exception as e:
+            logger.warning("Broadcast progress update failed: %s", e)
+
+    async def _send(self, bot, job, uid: int, sem: asyncio.Semaphore, on_blocked):
+        async with sem:
+            if self._stop:
+                return
+            try:
+                if job["text"] is not None:
+                    await bot.send_message(uid, job["text"], rate_limit_args=BULK)
+                else:
+                    await bot.copy_message(uid, job["from_chat_id"], job["message_id"], rate_limit_args=BULK)
+                job["sent"] += 1
+            except Forbidden:
+                job["blocked"] += 1
+                on_blocked(uid)
+            except TelegramError as e:
+                job["failed"] += 1
+                logger.debug("Broadcast to %s failed: %s", uid, e)
+
+    async def _report(self, job, on_progress):
+        while True:
+            await asyncio.sleep(self.progress_every)
+            try:
+                await on_progress(job)
+            except Exception as e:
+                logger.warning("Broadcast progress update failed: %s", e)
+
+
+def format_progress(job: Dict[str, Any]) -> str:
+    done = job["sent"] + job["blocked"] + job["failed"]
+    elapsed = max(time.time() - job["started"], 1e-6)
+    state = {"done": "✅ finished", "stopped": "⏹ stopped"}.get(job["finished"], "📣 running")
+    return (f"Broadcast {state}\n"
+            f"{done}/{job['total']} processed ({done / elapsed:.1f}/s)\n"
+            f"sent: {job['sent']}  blocked: {job['blocked']}  failed: {job['failed']}")
@@ -0,0 +1,210 @@
+"""
+Columnar mirror of the user table for admin analytics (v20fix.py).
+
+UserColumns keeps one NumPy array per column, one row per user:
+- balance, referrals, daily_income (WCoin/day of active machines)
+- machines: bitmask of the active machine numbers (bit n = machine n)
+The bot writes a user's row whenever it changes one of them (sync_columns in
+v20fix.py), so totals like the outstanding liability and filters such as
+"balance >= 100000 and owns machine 4" are a few vectorized passes instead
+of a loop over every user record.
+
+NumPy is optional (`pip install numpy`). Without it open_columns() returns a
+RowScan, which answers the same questions by walking the user records.
+"""
+
+import logging
+import operator
+import re
+from itertools import chain
+from typing import Callable, Collection, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+Row = Tuple[int, int, int, int, int]  # (user_id, balance, referrals, machines bitmask, daily_income)
+Condition = Tuple[str, str, int]  # (column, op, value), e.g. ("balance", ">=", 100000)
+
+OPS = {">=": operator.ge, "<=": operator.le, ">": operator.gt, "<": operator.lt, "=": operator.eq}
+_CONDITION = re.compile(r"^(balance|referrals|income|machine)(>=|<=|>|<|=)(\d+)$")
+
+
+def parse_condition(text: str, machine_nos: Collection[int]) -> Condition:
+    """
+    "balance>=100000", "referrals>9", "income<5000", "machine=4" (owns machine 4,
+    one of `machine_nos`) or "machine=0" (owns none). Raises ValueError on anything
+    else, including unknown machine numbers.
+    """
+    m = _CONDITION.match(text.lower())
+    if not m:
+        raise ValueError(text)
+    column, op, value = m.group(1), m.group(2), int(m.group(3))
+    if column == "machine" and (op != "=" or value and value not in machine_nos):
+        raise ValueError(text)
+    return ("daily_income" if column == "income" else column, op, value)
+
+
+class UserColumns:
+    """
+    NumPy-backed columns; rows are appended for new users and never move.
+    A user's row is found by binary search over the ids sorted at the last
+    reindex, or in a small dict of rows added since (a dict over every user
+    would cost ~100 bytes each, more than the columns themselves).
+    rebuild() without rows (boot) defers the build to the first query, from
+    `source()`; set() is a no-op until then.
+    """
+
+    def __init__(self, source: Callable[[], Iterable[Row]], capacity: int = 1024):
+        self.source = source
+        self.n = 0
+        self._stale = False
+        self._alloc(capacity)
+        self._reindex()
+
+    def __len__(self) -> int:
+        self._fresh()
+        return self.n
+
+    def _fresh(self):
+        if self._stale:
+            self.rebuild(self.source())
+
+    def _alloc(self, capacity: int, keep: int = 0):
+        """(Re)allocate every column with room for `capacity` rows, copying the first `keep`."""
+        cols = {"ids": np.int64, "balance": np.int64, "referrals": np.int64, "machines": np.uint64,
+                "daily_income": np.int64}
+        for name, dtype in cols.items():
+            arr = np.zeros(capacity, dtype=dtype)
+            if keep:
+                arr[:keep] = getattr(self, name)[:keep]
+            setattr(self, name, arr)
+
+    def rebuild(self, rows: Optional[Iterable[Row]] = None):
+        """Replace every row (boot); None = from `source()` on the first query."""
+        self._stale = rows is None
+        if rows is None:
+            return
+        table = np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, 5)
+        self._alloc(max(1024, len(table) + len(table) // 4))
+        self.n = len(table)
+        self.ids[:self.n] = table[:, 0]
+        self.balance[:self.n] = table[:, 1]
+        self.referrals[:self.n] = table[:, 2]
+        self.machines[:self.n] = table[:, 3].astype(np.uint64)
+        self.daily_income[:self.n] = table[:, 4]
+        self._reindex()
+
+    def _reindex(self):
+        self._order = np.argsort(self.ids[:self.n], kind="stable")  # rows by user id
+        self._sorted = self.ids[self._order]
+        self._recent: Dict[int, int] = {}  # user id -> row, for rows appended since
+
+    def _row(self, user_id: int) -> Optional[int]:
+        i = self._recent.get(user_id)
+        if i is None:
+            k = int(np.searchsorted(self._sorted, user_id))
+            if k < len(self._sorted) and self._sorted[k] == user_id:
+                i = int(self._order[k])
+        return i
+
+    def set(self, user_id: int, balance: int, referrals: int, machines: int, daily_income: int):
+        if self._stale:
+            return  # the deferred build reads the current value
+        i = self._row(user_id)
+        if i is None:
+            if self.n == len(self.ids):
+                self._alloc(self.n * 2, keep=self.n)
+            i = self._recent[user_id] = self.n
+            self.n += 1
+            self.ids[i] = user_id
+            if len(self._recent) > max(1024, self.n >> 4):
+                self._reindex()
+        self.balance[i] = balance
+        self.referrals[i] = referrals
+        self.machines[i] = machines
+        self.daily_income[i] = daily_income
+
+    def totals(self, machine_nos: Iterable[int]) -> Dict[str, int]:
+        self._fresh()
+        n = self.n
+        machines = self.machines[:n]
+        out = {"users": n, "liability": int(self.balance[:n].sum()), "daily_income": int(self.daily_income[:n].sum()),
+               "owners": int(np.count_nonzero(machines))}
+        for no in machine_nos:
+            out[f"machine_{no}"] = int(np.count_nonzero(machines & np.uint64(1 << no)))
+        return out
+
+    def select(self, conditions: List[Condition], offset: int, limit: int) -> Tuple[int, List[int]]:
+        """(number of matching users, ids of matches offset .. offset+limit in row order)."""
+        self._fresh()
+        n = self.n
+        hit = np.ones(n, dtype=bool)
+        for column, op, value in conditions:
+            if column == "machine":
+                machines = self.machines[:n]
+                hit &= machines == 0 if value == 0 else (machines & np.uint64(1 << value)) != 0
+            else:
+                hit &= OPS[op](getattr(self, column)[:n], value)
+        rows = np.flatnonzero(hit)
+        return len(rows), self.ids[rows[offset:offset + limit]].tolist()
+
+
+class RowScan:
+    """Fallback without NumPy: the same answers from a full pass over `source()` rows."""
+
+    def __init__(self, source: Callable[[], Iterable[Row]]):
+        self.source = source
+
+    def rebuild(self, rows: Optional[Iterable[Row]] = None):
+        pass
+
+    def set(self, user_id: int, balance: int, referrals: int, machines: int, daily_income: int):
+        pass
+
+    def totals(self, machine_nos: Iterable[int]) -> Dict[str, int]:
+        nos = list(machine_nos)
+        out = {"users": 0, "liability": 0, "daily_income": 0, "owners": 0}
+        out.update((f"machine_{no}", 0) for no in nos)
+        for _, balance, _, machines, income in self.source():
+            out["users"] += 1
+            out["liability"] += balance
+            out["daily_income"] += income
+            if machines:
+                out["owners"] += 1
+                for no in nos:
+                    if machines >> no & 1:
+                        out[f"machine_{no}"] += 1
+        return out
+
+    def select(self, conditions: List[Condition], offset: int, limit: int) -> Tuple[int, List[int]]:
+        count = 0
+        ids = []
+        for row in self.source():
+            if all(_matches(row, c) for c in conditions):
+                if offset <= count < offset + limit:
+                    ids.append(row[0])
+                count += 1
+        return count, ids
+
+
+_INDEX = {"balance": 1, "referrals": 2, "daily_income": 4}
+
+
+def _matches(row: Row, condition: Condition) -> bool:
+    column, op, value = condition
+    if column == "machine":
+        return row[3] == 0 if value == 0 else bool(row[3] >> value & 1)
+    return OPS[op](row[_INDEX[column]], value)
+
+
+def open_columns(source: Callable[[], Iterable[Row]], enabled: bool = True):
+    """UserColumns when NumPy is installed (and enabled), else a RowScan over `source`."""
+    if enabled and np is not None:
+        return UserColumns(source)
+    if enabled:
+        logger.info("NumPy not installed: admin analytics scan the user records (pip install numpy)")
+    return RowScan(source)
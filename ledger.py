@@ -0,0 +1,200 @@
+"""
+Append-only balance ledger for the WCoin bot (v20fix.py).
+
+Every credit/debit is appended as a fixed-size binary record; the per-user
+balance in USERS is the materialized view of the ledger, so reading a balance
+stays O(1). Periodic checkpoints store all balances together with the ledger
+offset they correspond to, so any balance can be rebuilt by replaying only the
+records written after the last checkpoint.
+
+Files (for ledger path P):
+- P        records: seq, ts, user_id, amount, balance_after, kind
+- P.ckpt   header + (user_id, balance) pairs, replaced atomically
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# event kinds
+CLAIM = 1
+REFERRAL = 2
+PURCHASE = 3
+WITHDRAW = 4
+ADMIN_GRANT = 5
+
+KIND_NAMES = {CLAIM: "claim", REFERRAL: "referral", PURCHASE: "purchase",
+              WITHDRAW: "withdraw", ADMIN_GRANT: "admin_grant"}
+
+RECORD = struct.Struct("<QIqqqB")  # seq, ts, user_id, amount, balance_after, kind
+CKPT_HEADER = struct.Struct("<4sIQQQ")  # magic, version, seq, ledger offset, count
+CKPT_ENTRY = struct.Struct("<qq")  # user_id, balance
+CKPT_MAGIC = b"WLCK"
+CKPT_VERSION = 1
+
+
+class Ledger:
+    """
+    Append-only ledger file. With path=None every method is a no-op, so the
+    bot runs unchanged when no ledger is configured.
+    append() runs on the event loop while sync() and checkpoint() run in an
+    executor thread; `_lock` guards the file buffer and the counters they share.
+    """
+
+    def __init__(self, path: Optional[str], checkpoint_every: int = 50000):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.seq = 0
+        self.size = 0  # logical file size including buffered bytes
+        self._synced_seq = 0  # last seq known to be on disk (fsynced)
+        self._since_checkpoint = 0
+        self._fh = None
+        self._lock = threading.Lock()
+        if path:
+            self._open()
+
+    @property
+    def enabled(self) -> bool:
+        return self._fh is not None
+
+    def _open(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        whole = size - size % RECORD.size
+        if whole != size:
+            # torn write from a crash: drop the partial record
+            logger.warning("Ledger %s has a partial trailing record, truncating", self.path)
+            with open(self.path, "r+b") as fh:
+                fh.truncate(whole)
+        self._fh = open(self.path, "ab", buffering=64 * 1024)
+        self.size = whole
+        if whole:
+            with open(self.path, "rb") as fh:
+                fh.seek(whole - RECORD.size)
+                self.seq = RECORD.unpack(fh.read(RECORD.size))[0]
+        self._synced_seq = self.seq
+        ckpt = self._read_checkpoint_header()
+        self._since_checkpoint = self.seq - (ckpt[0] if ckpt else 0)
+
+    # ---- writing ----
+
+    def append(self, user_id: int, kind: int, amount: int, balance_after: int) -> int:
+        """Record one balance change; returns its sequence number."""
+        if self._fh is None:
+            return 0
+        with self._lock:
+            self.seq += 1
+            self._fh.write(RECORD.pack(self.seq, int(time.time()), user_id, amount, balance_after, kind))
+            self.size += RECORD.size
+            self._since_checkpoint += 1
+            return self.seq
+
+    def flush(self):
+        if self._fh is not None:
+            with self._lock:
+                self._fh.flush()
+
+    def unsynced(self) -> bool:
+        """Records were appended since the last sync()."""
+        return self._fh is not None and self.seq != self._synced_seq
+
+    def sync(self):
+        """Flush and fsync: everything appended so far survives a host crash. Once per group commit."""
+        if self._fh is None:
+            return
+        with self._lock:
+            seq = self.seq
+            self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._synced_seq = seq
+
+    def checkpoint_due(self) -> bool:
+        return self._fh is not None and self._since_checkpoint >= self.checkpoint_every
+
+    def checkpoint(self, balances: Iterable[Tuple[int, int]], seq: Optional[int] = None,
+                   offset: Optional[int] = None):
+        """
+        Write all balances as of (seq, offset). When called from another thread,
+        take seq/offset on the loop thread together with the balances and pass them in.
+        """
+        if self._fh is None:
+            return
+        seq = self.seq if seq is None else seq
+        offset = self.size if offset is None else offset
+        self.flush()
+        entries = [CKPT_ENTRY.pack(uid, bal) for uid, bal in balances]
+        tmp = self.path + ".ckpt.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(CKPT_HEADER.pack(CKPT_MAGIC, CKPT_VERSION, seq, offset, len(entries)))
+            fh.write(b"".join(entries))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path + ".ckpt")
+        with self._lock:
+            self._since_checkpoint = self.seq - seq
+        logger.info("Ledger checkpoint at seq %d (%d balances)", seq, len(entries))
+
+    def close(self):
+        if self._fh is not None:
+            with self._lock:
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+                self._fh.close()
+                self._fh = None
+
+    # ---- reading ----
+
+    def has_checkpoint(self) -> bool:
+        return self._read_checkpoint_header() is not None
+
+    def _read_checkpoint_header(self):
+        try:
+            with open(self.path + ".ckpt", "rb") as fh:
+                magic, version, seq, offset, count = CKPT_HEADER.unpack(fh.read(CKPT_HEADER.size))
+        except (OSError, struct.error):
+            return None
+        if magic != CKPT_MAGIC or version != CKPT_VERSION:
+            return None
+        return seq, offset, count
+
+    def _read_checkpoint(self) -> Tuple[int, Dict[int, int]]:
+        """Return (ledger offset, balances) of the last checkpoint, or (0, {})."""
+        header = self._read_checkpoint_header()
+        if not header:
+            return 0, {}
+        _, offset, count = header
+        with open(self.path + ".ckpt", "rb") as fh:
+            fh.seek(CKPT_HEADER.size)
+            data = fh.read(count * CKPT_ENTRY.size)
+        return offset, dict(CKPT_ENTRY.iter_unpack(data))
+
+    def events(self, offset: int = 0) -> Iterator[Tuple[int, int, int, int, int, int]]:
+        """Iterate records (seq, ts, user_id, amount, balance_after, kind) from a byte offset."""
+        if not self.path:
+            return
+        self.flush()
+        with open(self.path, "rb") as fh:
+            fh.seek(offset)
+            while True:
+                chunk = fh.read(RECORD.size * 4096)
+                if not chunk:
+                    break
+                usable = len(chunk) - len(chunk) % RECORD.size
+                yield from RECORD.iter_unpack(chunk[:usable])
+
+    def replay(self, user_id: Optional[int] = None) -> Dict[int, int]:
+        """
+        Rebuild balances from the last checkpoint plus the ledger tail.
+        With user_id only that user's balance is rebuilt.
+        """
+        offset, balances = self._read_checkpoint()
+        if user_id is not None:
+            balances = {user_id: balances.get(user_id, 0)}
+        for _, _, uid, amount, _, _ in self.events(offset):
+            if user_id is None or uid == user_id:
+                balances[uid] = balances.get(uid, 0) + amount
+        return balances
@@ -0,0 +1,115 @@
+"""
+Per-user locking, update ordering and callback-query dedupe for the WCoin bot (v20fix.py).
+
+With concurrent update processing two updates from the same user can run
+interleaved at every await. Handlers that check a balance (or a machine's
+claim time) and then change it hold the user's lock across that section:
+
+    async with USER_LOCKS(uid):
+        ...
+
+Locks are created on demand and kept in weak-valued shards, so a lock lives
+exactly as long as some handler holds or waits for it and the table never
+grows with the user base. asyncio locks are not re-entrant: never take the
+same user's lock twice in one call chain.
+
+PerUserUpdateProcessor runs updates concurrently across users while each
+user's updates are handled one at a time, in arrival order.
+"""
+
+import asyncio
+import weakref
+from collections import deque
+from typing import Any, Awaitable, Deque, Hashable, List, Optional, Set
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class KeyedLocks:
+    def __init__(self, shards: int = 64):
+        self._shards: List[weakref.WeakValueDictionary] = [weakref.WeakValueDictionary() for _ in range(shards)]
+
+    def __call__(self, key: Hashable) -> asyncio.Lock:
+        shard = self._shards[hash(key) % len(self._shards)]
+        lock = shard.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            shard[key] = lock
+        return lock
+
+    def __len__(self) -> int:
+        """Locks currently alive (held or waited for)."""
+        return sum(len(s) for s in self._shards)
+
+
+class RecentIds:
+    """
+    Remembers the last `maxlen` ids. add() returns False for an id seen before,
+    e.g. a callback query Telegram delivers again after a restart or timeout.
+    """
+
+    def __init__(self, maxlen: int = 50000):
+        self._order: Deque[Hashable] = deque()
+        self._seen: Set[Hashable] = set()
+        self.maxlen = maxlen
+
+    def add(self, key: Hashable) -> bool:
+        if key in self._seen:
+            return False
+        self._seen.add(key)
+        self._order.append(key)
+        if len(self._order) > self.maxlen:
+            self._seen.discard(self._order.popleft())
+        return True
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Update processor for Application.builder().concurrent_updates(...).
+    - at most `max_in_flight` handlers run at the same time
+    - updates of one user (or chat, when there is no user) run sequentially in
+      arrival order; asyncio locks wake waiters FIFO
+    - the in-flight slot is taken only after the user's turn has come, so a user
+      flooding the bot queues behind themselves instead of occupying the slots
+    `max_pending` bounds updates admitted to the processor at all (PTB's own
+    semaphore); the rest wait in the Application's queue.
+    """
+
+    def __init__(self, max_in_flight: int, max_pending: Optional[int] = None):
+        super().__init__(max_pending or max_in_flight * 16)
+        self.max_in_flight = max_in_flight
+        self._slots = asyncio.BoundedSemaphore(max_in_flight)
+        self._locks = KeyedLocks()
+        self.in_flight = 0
+
+    @staticmethod
+    def ordering_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        return update.effective_chat.id if update.effective_chat else None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.ordering_key(update)
+        if key is None:
+            async with self._slots:
+                await self._run(coroutine)
+            return
+        async with self._locks(key):
+            async with self._slots:
+                await self._run(coroutine)
+
+    async def _run(self, coroutine: Awaitable[Any]):
+        self.in_flight += 1
+        try:
+            await coroutine
+        finally:
+            self.in_flight -= 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,229 @@
+"""
+Handler latency and Bot API call metrics for the WCoin bot (v20fix.py).
+
+Metrics.install(application, callback_actions) adds two TypeHandlers around
+the bot's own:
+- group -1 labels the update (callback_router:<action>, /<command>,
+  text_message_router, photo_message_router, ...) and starts the clock.
+  Labels come from fixed sets (registered commands, the given callback
+  actions) with an "other" bucket, so crafted payloads cannot add labels
+- the last group stops it and records the time in that label's histogram
+The label lives in a context variable for the rest of the update, so the
+outbound limiter's observer (see outbound.py) counts every Bot API call and
+error against the handler that made it. Calls made outside an update (timers,
+broadcasts) count as "background".
+
+Histograms are HDR-style (log-linear buckets, ~1.6% relative error) so
+recording is O(1) and p99 stays exact enough however many updates there are.
+Exposed as Prometheus text by serve() (GET /metrics) and as a table by
+format_stats() (admin /Stats). serve() needs aiohttp: `pip install aiohttp`.
+"""
+
+import contextvars
+import logging
+import re
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set
+
+from telegram import Update
+from telegram.ext import Application, CommandHandler, ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+CURRENT = contextvars.ContextVar("wcoin_handler", default="background")
+_STARTED = contextvars.ContextVar("wcoin_handler_started", default=0.0)
+
+END_GROUP = 1 << 20  # after every group the bot uses
+_ACTION_ARG = re.compile(r"[:_]*\d+$")  # catalog:2 -> catalog, buy_3 -> buy, claim::0 -> claim
+
+
+class Histogram:
+    """
+    HDR-style histogram of non-negative ints (microseconds here). Values below
+    2**precision are counted exactly; above that every power of two is split
+    into 2**(precision-1) equal buckets.
+    """
+
+    def __init__(self, precision: int = 7):
+        self.precision = precision
+        self.sub = 1 << precision
+        self.half = self.sub >> 1
+        self.counts: List[int] = []
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, v: int) -> int:
+        if v < self.sub:
+            return v
+        e = v.bit_length() - self.precision
+        return self.sub + (e - 1) * self.half + ((v >> e) - self.half)
+
+    def _value(self, i: int) -> int:
+        """Midpoint of bucket i."""
+        if i < self.sub:
+            return i
+        e, m = divmod(i - self.sub, self.half)
+        e += 1
+        return ((m + self.half) << e) + (1 << (e - 1))
+
+    def record(self, v: int):
+        v = max(0, int(v))
+        i = self._index(v)
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, q: float) -> int:
+        if not self.count:
+            return 0
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(self._value(i), self.max)
+        return self.max
+
+
+def label_update(update: Update, commands: Set[str], actions: Set[str]) -> str:
+    if update.callback_query:
+        action = _ACTION_ARG.sub("", update.callback_query.data or "")
+        return "callback_router:" + (action if action in actions else "other")
+    msg = update.message
+    if msg:
+        if msg.text and msg.text.startswith("/"):
+            cmd = msg.text[1:].split(maxsplit=1)[0].split("@")[0].lower() if len(msg.text) > 1 else ""
+            return f"/{cmd}" if cmd in commands else "/other"
+        if msg.photo:
+            return "photo_message_router"
+        if msg.text:
+            return "text_message_router"
+    if update.chat_member:
+        return "chat_member_update"
+    return "other"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self):
+        self.latency: Dict[str, Histogram] = {}  # label -> microseconds
+        self.errors: Counter = Counter()  # label -> handler exceptions
+        self.api_calls: Counter = Counter()  # (label, method) -> calls
+        self.api_errors: Counter = Counter()  # (label, method, error class) -> failed calls
+        self.started = time.time()
+        self._commands: Set[str] = set()
+        self._actions: Set[str] = set()
+
+    def install(self, application: Application, callback_actions: Iterable[str] = ()):
+        """
+        Call after the bot's handlers are registered. callback_actions: the
+        callback data the bot handles, without the numeric argument (catalog:2 -> catalog).
+        """
+        self._actions = set(callback_actions)
+        for handlers in application.handlers.values():
+            for h in handlers:
+                if isinstance(h, CommandHandler):
+                    self._commands.update(h.commands)
+        application.add_handler(TypeHandler(Update, self._begin), group=-1)
+        application.add_handler(TypeHandler(Update, self._end), group=END_GROUP)
+        application.add_error_handler(self._error)
+        observers = getattr(application.bot.rate_limiter, "observers", None)
+        if observers is not None:
+            observers.append(self.api_call)
+
+    async def _begin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        CURRENT.set(label_update(update, self._commands, self._actions))
+        _STARTED.set(time.perf_counter())
+
+    async def _end(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        label = CURRENT.get()
+        hist = self.latency.get(label)
+        if hist is None:
+            hist = self.latency[label] = Histogram()
+        hist.record((time.perf_counter() - _STARTED.get()) * 1e6)
+
+    async def _error(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        # replaces PTB's default "no error handlers" logging, so log here
+        self.errors[CURRENT.get() if isinstance(update, Update) else "background"] += 1
+        logger.error("Exception while handling %s", CURRENT.get(), exc_info=context.error)
+
+    def api_call(self, method: str, error: Optional[BaseException]):
+        """OutboundLimiter observer: one Bot API attempt finished."""
+        label = CURRENT.get()
+        self.api_calls[(label, method)] += 1
+        if error is not None:
+            self.api_errors[(label, method, type(error).__name__)] += 1
+
+    # ---- output ----
+
+    def prometheus(self) -> str:
+        out = ["# HELP wcoin_handler_seconds Time to handle an update, by handler.",
+               "# TYPE wcoin_handler_seconds summary"]
+        for label, h in sorted(self.latency.items()):
+            lab = _escape(label)
+            for q in (0.5, 0.95, 0.99):
+                out.append(f'wcoin_handler_seconds{{handler="{lab}",quantile="{q}"}} {h.percentile(q) / 1e6:.6f}')
+            out.append(f'wcoin_handler_seconds_sum{{handler="{lab}"}} {h.total / 1e6:.6f}')
+            out.append(f'wcoin_handler_seconds_count{{handler="{lab}"}} {h.count}')
+        out += ["# HELP wcoin_handler_errors_total Exceptions raised by handlers.",
+                "# TYPE wcoin_handler_errors_total counter"]
+        out += [f'wcoin_handler_errors_total{{handler="{_escape(k)}"}} {n}' for k, n in sorted(self.errors.items())]
+        out += ["# HELP wcoin_api_calls_total Bot API calls (attempts), by handler and method.",
+                "# TYPE wcoin_api_calls_total counter"]
+        out += [f'wcoin_api_calls_total{{handler="{_escape(k)}",method="{m}"}} {n}'
+                for (k, m), n in sorted(self.api_calls.items())]
+        out += ["# HELP wcoin_api_errors_total Failed Bot API calls, by handler, method and error.",
+                "# TYPE wcoin_api_errors_total counter"]
+        out += [f'wcoin_api_errors_total{{handler="{_escape(k)}",method="{m}",error="{e}"}} {n}'
+                for (k, m, e), n in sorted(self.api_errors.items())]
+        out += ["# TYPE wcoin_uptime_seconds gauge", f"wcoin_uptime_seconds {time.time() - self.started:.0f}"]
+        return "\n".join(out) + "\n"
+
+    def format_stats(self, limit: int = 15) -> str:
+        """Slowest handlers first (by p99), with call and error counts."""
+        calls: Counter = Counter()
+        errors: Counter = Counter()
+        for (label, _), n in self.api_calls.items():
+            calls[label] += n
+        for (label, _, _), n in self.api_errors.items():
+            errors[label] += n
+        rows = sorted(self.latency.items(), key=lambda kv: kv[1].percentile(0.99), reverse=True)[:limit]
+        lines = [f"Uptime {int(time.time() - self.started)}s - handler: n, p50/p95/p99 ms, api calls (errors)"]
+        for label, h in rows:
+            p = [h.percentile(q) / 1000 for q in (0.5, 0.95, 0.99)]
+            err = f", {self.errors[label]} exc" if self.errors[label] else ""
+            lines.append(f"{label}: {h.count}, {p[0]:.1f}/{p[1]:.1f}/{p[2]:.1f}, "
+                         f"{calls[label]} ({errors[label]}){err}")
+        if calls["background"]:
+            lines.append(f"background: {calls['background']} api calls ({errors['background']})")
+        return "\n".join(lines) if rows else "No updates handled yet"
+
+
+async def serve(metrics: Metrics, listen: str, port: int):
+    """Start the /metrics HTTP server; returns the runner (await runner.cleanup() to stop), None without aiohttp."""
+    try:
+        from aiohttp import web
+    except ImportError:
+        logger.warning("Metrics endpoint disabled: pip install aiohttp")
+        return None
+
+    async def handle(request: "web.Request") -> "web.Response":
+        return web.Response(body=metrics.prometheus().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    logger.info("Metrics on http://%s:%d/metrics", listen, port)
+    return runner
@@ -0,0 +1,304 @@
+"""
+Compact in-memory user records for the WCoin bot (v20fix.py).
+
+A plain user dict costs ~1 KB with one machine (the dict, its key table, a
+list and one more dict per machine). User keeps the known fields in
+__slots__ and packs the machines of a user into one int64 array of
+(machine_no, buy_ts, expire_ts, last_claim_ts, method) rows, about a third of
+that. Rarely used keys (admin payloads etc.) go to a small side dict.
+
+Both types keep the dict protocol the handlers use, so code like
+    u["balance"] += amount
+    for m in u["machines"]: m["last_claim_ts"] = now
+    u["machines"] = [m for m in u["machines"] if m["expire_ts"] > now]
+works unchanged. SQLite stores records as plain dicts (to_dict); the
+snapshot backend pickles User objects as one flat tuple each (machines stay
+one packed array), so a restart does not rebuild every record from a dict.
+bench/memory_bench.py compares both layouts.
+"""
+
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+MACHINE_FIELDS = ("machine_no", "buy_ts", "expire_ts", "last_claim_ts", "method")
+_TYPECODE = "q"
+_FIELD = {name: i for i, name in enumerate(MACHINE_FIELDS)}
+_WIDTH = len(MACHINE_FIELDS)
+_METHOD = _FIELD["method"]
+_NO, _EXPIRE = _FIELD["machine_no"], _FIELD["expire_ts"]
+# method strings are packed as an index into this tuple, and the packed rows are persisted
+# (snapshot pickles): codes must never change, so new methods may only be appended
+METHODS: Tuple[str, ...] = ("wave", "wcoin")
+_METHOD_CODES = {method: code for code, method in enumerate(METHODS)}
+
+_MISSING = object()
+
+
+def _method_code(method: str) -> int:
+    try:
+        return _METHOD_CODES[method]
+    except KeyError:
+        raise ValueError(f"Unknown machine payment method {method!r} (add it to models.METHODS)") from None
+
+
+class MachineInstance:
+    """One row of an owner's machine array; reads and writes go to the array."""
+
+    __slots__ = ("_rows", "_off")
+
+    def __init__(self, rows: array, off: int):
+        self._rows = rows
+        self._off = off
+
+    def __getitem__(self, key: str):
+        i = _FIELD[key]
+        v = self._rows[self._off + i]
+        return METHODS[v] if i == _METHOD else v
+
+    def __setitem__(self, key: str, value):
+        i = _FIELD[key]
+        self._rows[self._off + i] = _method_code(value) if i == _METHOD else value
+
+    def get(self, key: str, default=None):
+        return self[key] if key in _FIELD else default
+
+    def __contains__(self, key: str) -> bool:
+        return key in _FIELD
+
+    def keys(self):
+        return MACHINE_FIELDS
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: self[name] for name in MACHINE_FIELDS}
+
+    def __repr__(self) -> str:
+        return f"MachineInstance({self.to_dict()})"
+
+
+def _field(name: str) -> property:
+    return property(lambda self: self[name], lambda self, value: self.__setitem__(name, value))
+
+
+for _name in MACHINE_FIELDS:  # typed access: m.expire_ts, m.last_claim_ts = now, ...
+    setattr(MachineInstance, _name, _field(_name))
+
+
+def pack_machines(machines: Iterable[Any]) -> Optional[array]:
+    """Machine dicts / MachineInstances -> one flat array (None when there are none)."""
+    rows = array(_TYPECODE)
+    for m in machines:
+        rows.extend((m["machine_no"], m["buy_ts"], m["expire_ts"], m["last_claim_ts"], _method_code(m["method"])))
+    return rows if rows else None
+
+
+class Machines:
+    """List-like view of a user's machines (iterate, index, len, append)."""
+
+    __slots__ = ("_user",)
+
+    def __init__(self, user: "User"):
+        self._user = user
+
+    def __len__(self) -> int:
+        rows = self._user._machines
+        return len(rows) // _WIDTH if rows else 0
+
+    def __iter__(self) -> Iterator[MachineInstance]:
+        rows = self._user._machines
+        if rows:
+            for off in range(0, len(rows), _WIDTH):
+                yield MachineInstance(rows, off)
+
+    def __getitem__(self, i: int) -> MachineInstance:
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(i)
+        return MachineInstance(self._user._machines, i * _WIDTH)
+
+    def column(self, name: str):
+        """One field of every row (e.g. "expire_ts"), without building a MachineInstance per row."""
+        rows = self._user._machines
+        return rows[_FIELD[name]::_WIDTH] if rows else ()
+
+    def append(self, m: Any):
+        row = pack_machines([m])
+        if self._user._machines is None:
+            self._user._machines = row
+        else:
+            self._user._machines.extend(row)
+
+    def __repr__(self) -> str:
+        return repr([m.to_dict() for m in self])
+
+
+class User:
+    """A user record with dict-style access (see module docstring)."""
+
+    __slots__ = ("id", "username", "balance", "referrals", "referred_by", "referral_credited", "_machines",
+                 "withdraw_account", "withdraw_fail_count", "awaiting", "pending_order", "skip_verified",
+                 "claim_reminders", "blocked", "_extra")
+
+    FIELDS = ("id", "username", "balance", "referrals", "referred_by", "referral_credited", "machines",
+              "withdraw_account", "withdraw_fail_count", "awaiting", "pending_order", "skip_verified",
+              "claim_reminders", "blocked")
+    _SLOTS = frozenset(FIELDS) - {"machines"}
+
+    def __init__(self, id: int, username: str, balance: int = 0, referrals: int = 0,
+                 referred_by: Optional[int] = None, referral_credited: bool = False, machines: Iterable[Any] = (),
+                 withdraw_account: Optional[str] = None, withdraw_fail_count: int = 0, awaiting: Optional[str] = None,
+                 pending_order: Optional[Dict[str, Any]] = None, skip_verified: bool = False,
+                 claim_reminders: bool = False, blocked: bool = False):
+        self.id = id
+        self.username = username
+        self.balance = balance
+        self.referrals = referrals
+        self.referred_by = referred_by
+        self.referral_credited = referral_credited
+        self._machines = pack_machines(machines)
+        self.withdraw_account = withdraw_account
+        self.withdraw_fail_count = withdraw_fail_count
+        self.awaiting = awaiting
+        self.pending_order = pending_order
+        self.skip_verified = skip_verified
+        self.claim_reminders = claim_reminders
+        self.blocked = blocked
+        self._extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "User":
+        """A stored record (unknown keys are kept in the side dict)."""
+        if isinstance(d, cls):
+            return d
+        # attribute by attribute rather than cls(**d): this runs once per user at boot
+        u = cls.__new__(cls)
+        get = d.get
+        u.id = d["id"]
+        u.username = d["username"]
+        u.balance = get("balance", 0)
+        u.referrals = get("referrals", 0)
+        u.referred_by = get("referred_by")
+        u.referral_credited = get("referral_credited", False)
+        machines = get("machines")
+        u._machines = pack_machines(machines) if machines else None
+        u.withdraw_account = get("withdraw_account")
+        u.withdraw_fail_count = get("withdraw_fail_count", 0)
+        u.awaiting = get("awaiting")
+        u.pending_order = get("pending_order")
+        u.skip_verified = get("skip_verified", False)
+        u.claim_reminders = get("claim_reminders", False)
+        u.blocked = get("blocked", False)
+        u._extra = None if d.keys() <= _USER_KEYS else {k: v for k, v in d.items() if k not in _USER_KEYS}
+        return u
+
+    def __reduce__(self):
+        # one flat tuple per user, machines as raw bytes: unpickling skips the per-field dict, the machine
+        # re-packing and array's own (slow) reconstructor
+        machines = self._machines.tobytes() if self._machines else None
+        return _restore, (self.id, self.username, self.balance, self.referrals, self.referred_by,
+                          self.referral_credited, machines, self.withdraw_account, self.withdraw_fail_count,
+                          self.awaiting, self.pending_order, self.skip_verified, self.claim_reminders,
+                          self.blocked, self._extra)
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = {k: self[k] for k in self.FIELDS}
+        d["machines"] = [m.to_dict() for m in self.machines]
+        if self._extra:
+            d.update(self._extra)
+        return d
+
+    @property
+    def machines(self) -> Machines:
+        return Machines(self)
+
+    def machine_expiries(self) -> Tuple[Tuple[int, int], ...]:
+        """(machine_no, expire_ts) of every machine, without the views (load_state runs this per user)."""
+        rows = self._machines
+        if not rows:
+            return ()
+        if len(rows) == _WIDTH:
+            return ((rows[_NO], rows[_EXPIRE]),)
+        return tuple(zip(rows[_NO::_WIDTH], rows[_EXPIRE::_WIDTH]))
+
+    # ---- dict protocol ----
+
+    def __getitem__(self, key: str):
+        if key in self._SLOTS:
+            return getattr(self, key)
+        if key == "machines":
+            return Machines(self)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key in self._SLOTS:
+            setattr(self, key, value)
+        elif key == "machines":
+            self._machines = pack_machines(value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._SLOTS or key == "machines" or bool(self._extra and key in self._extra)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key: str, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key: str, default=_MISSING):
+        """Side-dict keys only; the fixed fields always exist."""
+        if self._extra and key in self._extra:
+            value = self._extra.pop(key)
+            if not self._extra:
+                self._extra = None
+            return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def keys(self) -> List[str]:
+        return list(self.FIELDS) + list(self._extra or ())
+
+    def __repr__(self) -> str:
+        return f"User({self.to_dict()})"
+
+
+_USER_KEYS = frozenset(User.FIELDS)
+
+
+def _restore(id, username, balance, referrals, referred_by, referral_credited, machines, withdraw_account,
+             withdraw_fail_count, awaiting, pending_order, skip_verified, claim_reminders, blocked, extra) -> User:
+    """Unpickle a User (see User.__reduce__)."""
+    u = User.__new__(User)
+    u.id = id
+    u.username = username
+    u.balance = balance
+    u.referrals = referrals
+    u.referred_by = referred_by
+    u.referral_credited = referral_credited
+    u._machines = array(_TYPECODE, machines) if machines else None
+    u.withdraw_account = withdraw_account
+    u.withdraw_fail_count = withdraw_fail_count
+    u.awaiting = awaiting
+    u.pending_order = pending_order
+    u.skip_verified = skip_verified
+    u.claim_reminders = claim_reminders
+    u.blocked = blocked
+    u._extra = extra
+    return u
+
+
+def plain(record: Any) -> Dict[str, Any]:
+    """The dict to persist for a user record (User or an already plain dict)."""
+    return record.to_dict() if isinstance(record, User) else record
@@ -0,0 +1,218 @@
+"""
+Outbound Bot API scheduler for the WCoin bot (v20fix.py).
+
+Plugged into the Application with `.rate_limiter(OutboundLimiter())`, so every
+Bot API call goes through it.
+- message endpoints (send*/edit*/copy*/forward*) take a token from a per-chat
+  bucket (~1/s private chats, 20/min groups and channels) and then from the
+  global bucket (~30/s)
+- the global bucket is handed out by priority lane: INTERACTIVE replies go
+  before BACKGROUND notifications, which go before BULK broadcasts
+- RetryAfter pauses the affected chat (or everything, for calls without a
+  chat) and retries the call up to `max_retries` times; other endpoints
+  (getChatMember, answerCallbackQuery, ...) skip the buckets but still wait
+  out a global pause and their own RetryAfter before trying again
+- `observers` are called as observer(endpoint, error_or_None) after every
+  attempt (see metrics.py)
+Pick the lane per call with `rate_limit_args=BACKGROUND` etc.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# priority lanes (lower runs first)
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+
+LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+
+
+def retry_after_seconds(exc: RetryAfter) -> float:
+    value = exc.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations: reserve() books the next token and
+    returns how long the caller has to wait for it, so waiters are served FIFO.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self, now: float) -> float:
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, now: float, seconds: float):
+        """Drain the bucket so the next token is only available after `seconds`."""
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class OutboundLimiter(BaseRateLimiter[int]):
+    def __init__(self, global_rate: float = 30.0, private_rate: float = 1.0, group_rate: float = 20 / 60,
+                 chat_burst: float = 3.0, max_retries: int = 3, default_priority: int = INTERACTIVE):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.default_priority = default_priority
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []  # (priority, seq, future)
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._paused_until = 0.0
+        self.waiting = [0, 0, 0]  # per lane, for metrics / progress reports
+        self.observers: List[Callable[[str, Optional[BaseException]], None]] = []
+
+    async def initialize(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._global = TokenBucket(self.global_rate, self.global_rate, loop.time())
+        self._wakeup = asyncio.Event()
+        self._dispatcher = loop.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, fut in self._queue:
+            fut.cancel()
+        self._queue.clear()
+
+    # ---- global bucket, by lane ----
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = loop.time()
+            wait = max(self._global.wait_time(now), self._paused_until - now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, fut = heapq.heappop(self._queue)
+            if fut.done():  # caller gave up (cancelled)
+                continue
+            self._global.reserve(now)
+            fut.set_result(None)
+
+    async def _acquire_global(self, priority: int):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), fut))
+        self._wakeup.set()
+        lane = min(priority, len(self.waiting) - 1)
+        self.waiting[lane] += 1
+        try:
+            await fut
+        finally:
+            self.waiting[lane] -= 1
+
+    # ---- per-chat buckets ----
+
+    def _chat_bucket(self, chat_id: Union[int, str], now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                for key in [k for k, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[key]
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(self.private_rate if private else self.group_rate, self.chat_burst, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Any:
+        priority = self.default_priority if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        limited = endpoint.startswith(LIMITED_PREFIXES)
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                if chat_id is not None:
+                    delay = self._chat_bucket(chat_id, loop.time()).reserve(loop.time())
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await self._acquire_global(priority)
+            else:
+                pause = self._paused_until - loop.time()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                self._observe(endpoint, exc)
+                seconds = retry_after_seconds(exc) + 0.1
+                if attempt == self.max_retries:
+                    logger.error("%s to %s still rate limited after %d retries", endpoint, chat_id, attempt)
+                    raise
+                logger.info("%s to %s hit RetryAfter, retrying in %.1fs", endpoint, chat_id, seconds)
+                now = loop.time()
+                if chat_id is not None:
+                    self._chat_bucket(chat_id, now).pause(now, seconds)
+                else:
+                    self._paused_until = max(self._paused_until, now + seconds)
+                if not limited:
+                    # limited calls wait in the chat bucket / global queue; nothing else would
+                    await asyncio.sleep(seconds)
+            except Exception as exc:
+                self._observe(endpoint, exc)
+                raise
+            else:
+                self._observe(endpoint, None)
+                return result
+        return None
+
+    def _observe(self, endpoint: str, error: Optional[BaseException]):
+        for observer in self.observers:
+            observer(endpoint, error)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Horizontal sharding for the WCoin bot (v20fix.py).
+
+    WCOIN_DB=/data/wcoin.db WCOIN_ADMINS=111,222 python sharding.py --workers 4
+
+Processes:
+- front (this process): long-polls getUpdates and routes each update by user
+  id: admins' updates go to the coordinator, everyone else's to worker
+  `user_id % N`. Each process has one FIFO inbox, so a user's updates stay in
+  order (and PerUserUpdateProcessor keeps them in order inside the worker).
+- workers: run v20fix with only their own users in memory.
+- coordinator: runs the admin commands. It keeps a read mirror of every user,
+  refreshed from the store before each update, so /Total_user, /TopB, /Mowner
+  etc. see all shards (as of the workers' last group commit). Changes to a
+  user are sent as ops to the owning worker (v20fix.SHARD_OPS).
+All processes share one SQLite store (WAL, disjoint rows per process); the
+ledger, if enabled, is one file per process.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application
+
+from outbound import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+COORDINATOR = -1
+
+# this process's handles on every inbox (set in worker processes)
+_inboxes: Dict[int, Any] = {}
+
+
+def shard_for(user_id: Optional[int], shards: int, admins: Iterable[int]) -> int:
+    if user_id is None or user_id in admins:
+        return COORDINATOR
+    return user_id % shards
+
+
+def routing_user(update: Update) -> Optional[int]:
+    """
+    The user whose shard handles an update. chat_member updates belong to the
+    member who joined or left (the actor may be an admin who added them).
+    """
+    if update.chat_member:
+        return update.chat_member.new_chat_member.user.id
+    user = update.effective_user
+    return user.id if user else (update.effective_chat.id if update.effective_chat else None)
+
+
+def send_op(shard: int, name: str, args: tuple):
+    """Run SHARD_OPS[name](bot, *args) in the process owning `shard`."""
+    _inboxes[shard].put(("op", name, args))
+
+
+# ---------------- worker / coordinator side ----------------
+
+
+async def serve(application: Application, inbox, run_op: Callable[[Any, str, tuple], Awaitable[None]]):
+    """Run the Application on updates and ops from the inbox until the front sends None."""
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        while True:
+            msg = await loop.run_in_executor(None, inbox.get)
+            if msg is None:
+                break
+            if msg[0] == "update":
+                application.update_queue.put_nowait(Update.de_json(msg[1], application.bot))
+            else:
+                application.create_task(run_op(application.bot, msg[1], msg[2]))
+    finally:
+        await application.stop()  # handles what is already queued
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def worker_main(shard: int, shards: int, inboxes: Dict[int, Any]):
+    """Entry point of a worker / the coordinator process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the front stops us through the inbox
+    os.environ["WCOIN_SHARDS"] = str(shards)
+    os.environ["WCOIN_SHARD"] = str(shard)
+    import sharding  # not this module object when the front was started as a script (__mp_main__)
+    import v20fix
+    sharding._inboxes.update(inboxes)
+    v20fix.main(inbox=inboxes[shard])
+
+
+# ---------------- front ----------------
+
+
+async def front(token: str, shards: int, admins: Iterable[int], inboxes: Dict[int, Any]):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    admins = set(admins)
+    api_url = os.environ.get("WCOIN_API_URL")  # same override as v20fix.API_URL
+    bot = Bot(token, base_url=f"{api_url}/bot") if api_url else Bot(token)
+    async with bot:
+        await bot.delete_webhook()
+        offset = 0
+        while not stop.is_set():
+            poll = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES))
+            stopping = asyncio.ensure_future(stop.wait())
+            await asyncio.wait({poll, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+            if not poll.done():
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except (NetworkError, TimedOut) as e:
+                logger.warning("getUpdates failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+            except RetryAfter as e:
+                await asyncio.sleep(retry_after_seconds(e))
+                continue
+            except Exception:
+                # e.g. a Conflict with another poller or a bad response: keep the front alive
+                logger.exception("getUpdates failed")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                try:
+                    inboxes[shard_for(routing_user(update), shards, admins)].put(("update", update.to_dict()))
+                except Exception:
+                    logger.exception("Could not forward update %d, dropping it", update.update_id)
+                offset = update.update_id + 1
+        # confirm the forwarded updates so Telegram does not send them again
+        await bot.get_updates(offset=offset, timeout=0, limit=1)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    args = ap.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s",
+                        level=logging.INFO)
+    token = os.environ.get("BOT_TOKEN")
+    admins = {int(x) for x in os.environ.get("WCOIN_ADMINS", "").split(",") if x.strip()}
+    if not token or not admins or not os.environ.get("WCOIN_DB"):
+        raise SystemExit("Set BOT_TOKEN, WCOIN_ADMINS and WCOIN_DB (a SQLite store shared by all processes)")
+    if os.environ.get("WCOIN_BACKEND", "sqlite") != "sqlite":
+        raise SystemExit("Sharding needs the sqlite backend")
+
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = {shard: ctx.Queue() for shard in [COORDINATOR, *range(args.workers)]}
+    procs = [ctx.Process(target=worker_main, args=(shard, args.workers, inboxes),
+                         name="coordinator" if shard == COORDINATOR else f"worker-{shard}")
+             for shard in inboxes]
+    for p in procs:
+        p.start()
+    try:
+        asyncio.run(front(token, args.workers, admins, inboxes))
+    finally:
+        for q in inboxes.values():
+            q.put(None)
+        for p in procs:
+            p.join()
+
+
+if __name__ == "__main__":
+    main()
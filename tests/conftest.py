@@ -0,0 +1,11 @@
+"""Shared setup: the modules live in the repository root; v20fix reads its config from the environment at import."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("BOT_TOKEN", "1:test")
+for name in ("WCOIN_DB", "WCOIN_LEDGER", "WCOIN_SHARDS", "WCOIN_SHARD", "WCOIN_METRICS_PORT", "WCOIN_WEBHOOK_URL",
+             "WCOIN_BROADCAST_STATE"):
+    os.environ.pop(name, None)
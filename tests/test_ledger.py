@@ -0,0 +1,81 @@
+"""Crash recovery of the balance ledger (ledger.py) and of the balances load_state rebuilds from it."""
+
+import asyncio
+
+import v20fix
+from ledger import CLAIM, PURCHASE, RECORD, Ledger
+
+
+def test_replay_is_checkpoint_plus_tail(tmp_path):
+    path = str(tmp_path / "ledger")
+    ledger = Ledger(path)
+    ledger.append(1, CLAIM, 100, 100)
+    ledger.append(2, CLAIM, 50, 50)
+    ledger.checkpoint([(1, 100), (2, 50)])
+    ledger.append(1, PURCHASE, -30, 70)
+    ledger.append(3, CLAIM, 5, 5)
+    ledger.close()
+
+    reopened = Ledger(path)
+    assert reopened.seq == 4
+    assert reopened.replay() == {1: 70, 2: 50, 3: 5}
+    assert reopened.replay(user_id=1) == {1: 70}
+
+
+def test_torn_trailing_record_is_dropped(tmp_path):
+    path = str(tmp_path / "ledger")
+    ledger = Ledger(path)
+    ledger.append(1, CLAIM, 10, 10)
+    ledger.append(1, CLAIM, 10, 20)
+    ledger.close()
+    with open(path, "ab") as fh:  # crash in the middle of the third record
+        fh.write(RECORD.pack(3, 0, 1, 10, 30, CLAIM)[:RECORD.size // 2])
+
+    reopened = Ledger(path)
+    assert reopened.seq == 2
+    assert reopened.replay() == {1: 20}
+    assert reopened.append(1, CLAIM, 5, 25) == 3
+    reopened.close()
+    assert Ledger(path).replay() == {1: 25}
+
+
+def test_sync_only_when_records_were_appended(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger"))
+    assert not ledger.unsynced()
+    ledger.append(1, CLAIM, 1, 1)
+    assert ledger.unsynced()
+    ledger.sync()
+    assert not ledger.unsynced()
+    assert not Ledger(None).unsynced()
+
+
+def test_load_state_takes_balances_from_the_ledger(tmp_path, monkeypatch):
+    # the store's last group commit is behind the ledger (crash between the two)
+    ledger = Ledger(str(tmp_path / "ledger"))
+    ledger.checkpoint([(1, 5), (2, 7)])
+    ledger.append(1, CLAIM, 10, 15)
+    ledger.sync()
+    monkeypatch.setattr(v20fix, "LEDGER", ledger)
+    monkeypatch.setattr(v20fix.STORE, "load_users", lambda: iter([
+        {"id": 1, "username": "a", "balance": 5}, {"id": 2, "username": "b", "balance": 7}]))
+    dirty = []
+    monkeypatch.setattr(v20fix.WRITER, "mark_user", dirty.append)
+
+    v20fix.load_state()
+
+    assert v20fix.USERS[1]["balance"] == 15
+    assert v20fix.USERS[2]["balance"] == 7
+    assert dirty == [1]  # the corrected balance is written back
+    assert v20fix.TOP_BALANCE.page(0, 2) == [(1, 15), (2, 7)]
+
+
+def test_sync_ledger_skips_the_fsync_when_idle(tmp_path, monkeypatch):
+    ledger = Ledger(str(tmp_path / "ledger"))
+    synced = []
+    monkeypatch.setattr(ledger, "sync", lambda: synced.append(ledger.seq))
+    monkeypatch.setattr(v20fix, "LEDGER", ledger)
+    asyncio.run(v20fix.sync_ledger())
+    assert synced == []
+    ledger.append(1, CLAIM, 1, 1)
+    asyncio.run(v20fix.sync_ledger())
+    assert synced == [1]
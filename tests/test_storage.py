@@ -0,0 +1,128 @@
+"""Journal replay after a crash (storage.SnapshotStorage) and WriteBehind group-commit ordering."""
+
+import asyncio
+
+import pytest
+
+from models import User
+from storage import SnapshotStorage, SQLiteStorage, Storage, WriteBehind
+
+
+def user(uid, balance):
+    return User.from_dict({"id": uid, "username": f"u{uid}", "balance": balance, "machines": [
+        {"machine_no": 1, "buy_ts": 1, "expire_ts": 2, "last_claim_ts": 1, "method": "wcoin"}]})
+
+
+def test_snapshot_journal_survives_a_torn_frame(tmp_path):
+    path = str(tmp_path / "wcoin")
+    store = SnapshotStorage(path)
+    store.save_users([user(1, 10), user(2, 20)])
+    store.save_users([user(1, 15)])
+    store.close()
+    segment = store._segment_path(store.segment)
+    with open(segment, "ab") as fh:  # crash in the middle of the next group commit
+        fh.write(SnapshotStorage.FRAME.pack(1000, 0) + b"partial")
+
+    users = {u["id"]: u for u in SnapshotStorage(path).load_users()}
+    assert {uid: u["balance"] for uid, u in users.items()} == {1: 15, 2: 20}
+    assert users[1]["machines"][0]["method"] == "wcoin"
+
+
+def test_snapshot_compaction_keeps_the_latest_records(tmp_path):
+    path = str(tmp_path / "wcoin")
+    store = SnapshotStorage(path)
+    store.save_users([user(1, 10), user(2, 20)])
+    store.compact(wait=True)
+    store.save_users([user(2, 25)])
+    store.save_orders("withdraw", [{"order_id": 7, "user_id": 2}])
+    store.close()
+
+    reopened = SnapshotStorage(path)
+    users = {u.id: u for u in reopened.load_users()}
+    assert {uid: u.balance for uid, u in users.items()} == {1: 10, 2: 25}
+    assert all(type(u) is User for u in users.values())
+    assert reopened.load_orders("withdraw") == [{"order_id": 7, "user_id": 2}]
+
+
+def test_sqlite_commits_survive_without_close(tmp_path):
+    path = str(tmp_path / "wcoin.db")
+    store = SQLiteStorage(path)
+    store.save_users([user(1, 10)])
+    store.delete_orders("machine", [3])  # the process dies here: no close(), no checkpoint
+    assert [u["balance"] for u in SQLiteStorage(path).load_users()] == [10]
+
+
+class RecordingStore(Storage):
+    """Encodes a user as (id, balance) and logs every write."""
+
+    durable = True
+
+    def __init__(self, events, fail=False):
+        self.events = events
+        self.fail = fail
+
+    def encode_user(self, u):
+        return (u["id"], u["balance"])
+
+    def write_batch(self, user_rows=(), order_rows=(), order_deletes=()):
+        if self.fail:
+            raise OSError("disk full")
+        self.events.append(("write", list(user_rows), list(order_rows), list(order_deletes)))
+
+
+def test_flush_encodes_the_batch_before_the_hooks_run():
+    events = []
+    users = {1: {"id": 1, "balance": 5}}
+    writer = WriteBehind(RecordingStore(events), users)
+
+    async def sync_log():
+        events.append(("hook",))
+        await asyncio.sleep(0)
+        users[1]["balance"] = 99  # changed while the hook is awaited (e.g. fsync in an executor)
+        writer.mark_user(1)
+
+    writer.before_flush.append(sync_log)
+
+    async def run():
+        writer.mark_user(1)
+        await writer.flush()
+        assert events == [("hook",), ("write", [(1, 5)], [], [])]
+        assert writer.pending() == 1  # the later change waits for the next batch, after the next hook
+        events.clear()
+        writer.before_flush.clear()
+        await writer.flush()
+        assert events == [("write", [(1, 99)], [], [])]
+
+    asyncio.run(run())
+
+
+def test_idle_flush_runs_hooks_but_writes_nothing():
+    events = []
+    writer = WriteBehind(RecordingStore(events), {})
+
+    async def hook():
+        events.append(("hook",))
+
+    writer.before_flush.append(hook)
+    asyncio.run(writer.flush())
+    assert events == [("hook",)]
+
+
+def test_failed_group_commit_is_requeued_and_newer_changes_win():
+    events = []
+    store = RecordingStore(events, fail=True)
+    users = {1: {"id": 1, "balance": 5}}
+    writer = WriteBehind(store, users)
+
+    async def run():
+        writer.mark_user(1)
+        writer.put_order("withdraw", {"order_id": 3, "status": "pending"})
+        with pytest.raises(OSError):
+            await writer.flush()
+        assert writer.pending() == 2
+        writer.delete_order("withdraw", 3)  # newer than the failed batch
+        store.fail = False
+        await writer.flush()
+
+    asyncio.run(run())
+    assert events == [("write", [(1, 5)], [], [("withdraw", 3)])]
@@ -0,0 +1,86 @@
+"""Input validation for admin filters (columnar.parse_condition) and callback data (v20fix.callback_router)."""
+
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+import v20fix
+from columnar import parse_condition
+
+_query_ids = itertools.count(1)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("balance>=100000", ("balance", ">=", 100000)),
+    ("Referrals>9", ("referrals", ">", 9)),
+    ("income<5000", ("daily_income", "<", 5000)),
+    ("machine=4", ("machine", "=", 4)),
+    ("machine=0", ("machine", "=", 0)),  # owns no active machine
+])
+def test_parse_condition_accepts(text, expected):
+    assert parse_condition(text, v20fix.MACHINES) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "machine=64", "machine=9", "machine>1", "balance>=-1", "balance>=1e9", "balance", "owner=1", "",
+])
+def test_parse_condition_rejects(text):
+    with pytest.raises(ValueError):
+        parse_condition(text, v20fix.MACHINES)
+
+
+@pytest.fixture
+def menus(monkeypatch):
+    calls = []
+
+    async def joined(context, user_id, fresh=False):
+        return True
+
+    def recorder(name):
+        async def menu(q, context, *args):
+            calls.append((name,) + args)
+        return menu
+
+    monkeypatch.setattr(v20fix, "has_joined_all_channels", joined)
+    for name in ("buy_machine_menu", "machines_menu", "toggle_reminders"):
+        monkeypatch.setattr(v20fix, name, recorder(name))
+    monkeypatch.setattr(v20fix, "ensure_user", lambda user_id, username=None: {})
+    return calls
+
+
+def press(data):
+    async def answer(*args, **kwargs):
+        pass
+
+    q = SimpleNamespace(id=str(next(_query_ids)), data=data, answer=answer,
+                        from_user=SimpleNamespace(id=42, username="tester"))
+    asyncio.run(v20fix.callback_router(SimpleNamespace(callback_query=q), SimpleNamespace()))
+
+
+@pytest.mark.parametrize("data", [
+    "catalog:", "catalog:x", "catalog:-1", "catalog:1e3", "owned", "owned:1:2", "reminders:²", "reminders: 1",
+])
+def test_callback_router_ignores_malformed_pages(menus, data):
+    press(data)
+    assert menus == []
+
+
+def test_callback_router_dispatches_page_numbers(menus):
+    for data in ("catalog:2", "owned:0", "reminders:1"):
+        press(data)
+    assert menus == [("buy_machine_menu", 2), ("machines_menu", 0), ("toggle_reminders", 1)]
+
+
+def test_users_command_rejects_unknown_machine(monkeypatch):
+    replies = []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    admin = next(iter(v20fix.ADMIN_USER_IDS))
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=admin), message=SimpleNamespace(reply_text=reply_text))
+    asyncio.run(v20fix.cmd_users(update, SimpleNamespace(args=["machine=64"])))
+    assert len(replies) == 1 and replies[0].startswith("Invalid filter: machine=64")
+    assert "Usage: /Users" in replies[0]
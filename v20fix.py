@@ -14,6 +14,13 @@ WCoin Telegram Bot - full version (new.py)
   * Withdraw logic with 3 rules & admin skip
   * Admin commands for payouts, orders, images, add balance, skip, stats
 NOTE: This is a single-file reference implementation. It's meant for local testing.
+- Optional persistence: set WCOIN_DB to a database path and WCOIN_BACKEND to
+  "sqlite" (default) or "snapshot" (see storage.py)
+- Optional balance ledger: set WCOIN_LEDGER to a file path (see ledger.py)
+- Optional webhook mode: set WCOIN_WEBHOOK_URL and WCOIN_WEBHOOK_SECRET (see webhook.py)
+- Optional sharding over several processes: run sharding.py instead of this file
+- Optional Prometheus endpoint: set WCOIN_METRICS_PORT (see metrics.py); admins get /Stats
+- Optional NumPy column mirror for admin analytics (/Total_user, /Users): pip install numpy (see columnar.py)
 
 Modified to be compatible with `python-telegram-bot` version 20+.
 - Replaced `Updater` with `Application`.
@@ -26,10 +33,17 @@ Modified to be compatible with `python-telegram-bot` version 20+.
 """
 
 import os
+import asyncio
+import gc
 import logging
 import time
+import heapq
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Set, Iterator, Iterable, Tuple, Callable
 
 from telegram import (
     Update,
@@ -38,24 +52,79 @@ from telegram import (
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
 
+from storage import open_storage, WriteBehind, MACHINE_ORDER, WITHDRAW_ORDER
+from ledger import Ledger, CLAIM, REFERRAL, PURCHASE, WITHDRAW, ADMIN_GRANT
+from outbound import OutboundLimiter, BACKGROUND
+from broadcast import Broadcaster, new_job, format_progress
+from locks import KeyedLocks, RecentIds, PerUserUpdateProcessor
+from models import User
+from columnar import open_columns, parse_condition
+import metrics
+import webhook
+import sharding
+
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
+API_URL = os.environ.get("WCOIN_API_URL")  # Bot API server; unset = api.telegram.org (see bench/fake_botapi.py)
 if not BOT_TOKEN:
     raise RuntimeError("Set BOT_TOKEN environment variable before running")
 
 # Put your actual channel usernames (public) here, e.g. "@yourchannel"
 REQUIRED_CHANNELS = ["@your_channel"]  # users must join these channels
 PAYOUT_HISTORY_CHANNEL = "@payout_history_by_waveMiner"  # channel to post payout receipts
-ADMIN_USER_IDS = {123456789}  # replace with real admin telegram ids (ints)
+ADMIN_USER_IDS = {int(x) for x in os.environ.get("WCOIN_ADMINS", "").split(",") if x.strip()} or {
+    123456789}  # replace with real admin telegram ids (ints), or set WCOIN_ADMINS=id1,id2
+MEMBERSHIP_TTL = 600  # seconds a polled "joined" result is trusted before asking Telegram again
+MEMBERSHIP_NEGATIVE_TTL = 20  # seconds a polled "not joined" / failed check is cached
+MEMBERSHIP_EVENT_TTL = 86400  # seconds a chat_member join/leave event is trusted (re-polled after, in case one was missed)
+MEMBERSHIP_CACHE_SIZE = 200000  # max users kept per channel in CHANNEL_MEMBERS (least recently written evicted)
+MEMBERSHIP_WARM_USERS = 5000  # newest users whose membership is polled at boot
+MEMBERSHIP_WARM_CONCURRENCY = 8
+CATALOG_PAGE_SIZE = 4  # machines per page in the buy / machines menus (one message per menu)
+DATABASE_PATH = os.environ.get("WCOIN_DB")  # database path; unset = in-memory only
+STORAGE_BACKEND = os.environ.get("WCOIN_BACKEND", "sqlite")  # "sqlite" or "snapshot" (see storage.py)
+FLUSH_INTERVAL_MS = int(os.environ.get("WCOIN_FLUSH_MS", "50"))  # group commit every N ms
+FLUSH_MAX_BATCH = int(os.environ.get("WCOIN_FLUSH_BATCH", "1000"))  # ...or as soon as M records are dirty
+LEDGER_PATH = os.environ.get("WCOIN_LEDGER")  # append-only balance ledger file; unset = no ledger
+LEDGER_CHECKPOINT_EVERY = int(os.environ.get("WCOIN_LEDGER_CHECKPOINT", "50000"))  # events between checkpoints
+SEND_GLOBAL_RATE = 30  # outbound messages per second, all chats together (see outbound.py)
+SEND_PRIVATE_RATE = 1  # messages per second into one private chat
+SEND_GROUP_RATE = 20 / 60  # messages per second into one group / channel
+SEND_MAX_RETRIES = 3  # RetryAfter retries before a send is given up
+BROADCAST_STATE_PATH = os.environ.get("WCOIN_BROADCAST_STATE") or (DATABASE_PATH and DATABASE_PATH + ".broadcast")
+BROADCAST_CHUNK = 500  # recipients per checkpoint
+BROADCAST_CONCURRENCY = 30  # sends in flight during a broadcast
+EXPIRY_NOTIFY = True  # tell owners when a machine expires
+EXPIRY_NOTIFY_MAX_AGE = 86400  # ...unless it expired longer ago than this (e.g. while the bot was down)
+REMINDER_BATCH_SEC = 60  # claim reminders due within this window go out as one message
+CONCURRENT_UPDATES = int(os.environ.get("WCOIN_CONCURRENCY", "64"))  # handlers in flight; 1 = one update at a time
+WEBHOOK_URL = os.environ.get("WCOIN_WEBHOOK_URL")  # public https URL; unset = long polling
+WEBHOOK_SECRET = os.environ.get("WCOIN_WEBHOOK_SECRET")  # required with WEBHOOK_URL
+WEBHOOK_LISTEN = os.environ.get("WCOIN_WEBHOOK_LISTEN", "127.0.0.1")  # behind the reverse proxy
+WEBHOOK_PORT = int(os.environ.get("WCOIN_WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.environ.get("WCOIN_WEBHOOK_PATH", "/telegram")
+WEBHOOK_MAX_QUEUE = 10000  # queued updates before the server answers 503 (Telegram retries)
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = int(os.environ.get("WCOIN_METRICS_PORT", "0"))  # GET /metrics; 0 = off. Sharded: + shard + 1
+ANALYTICS_COLUMNS = os.environ.get("WCOIN_COLUMNS", "1") != "0"  # NumPy mirror for /Total_user, /Users; 0 = off
+USERS_PAGE_SIZE = 50  # ids per page of /Users
+SHARDS = int(os.environ.get("WCOIN_SHARDS", "1"))  # worker processes; set by sharding.py
+SHARD = int(os.environ.get("WCOIN_SHARD", "0"))  # this process: 0..SHARDS-1, or sharding.COORDINATOR
+if SHARDS > 1 and LEDGER_PATH:
+    LEDGER_PATH += ".coordinator" if SHARD == sharding.COORDINATOR else f".{SHARD}"  # one ledger per process
 
 # Machine definitions
 MACHINES = {
@@ -97,39 +166,784 @@ MACHINES = {
     },
 }
 
-# ---------------- STORAGE (in-memory for this sample) ----------------
-USERS: Dict[int, Dict[str, Any]] = {}
-MACHINE_ORDERS: List[Dict[str, Any]] = []  # pending machine orders (wave pay)
-WITHDRAW_REQUESTS: List[Dict[str, Any]] = []  # pending withdraw requests
-
 # ---------------- LOGGING ----------------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ---------------- STORAGE ----------------
+
+
+class OrderBook:
+    """
+    Pending orders keyed by order id (insertion order = queue order), with
+    secondary indexes by user and by status. Lookup, add and remove are O(1).
+    Every change is queued for persistence under `kind`.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.by_id: Dict[int, Dict[str, Any]] = {}
+        self.by_user: Dict[int, Set[int]] = {}
+        self.by_status: Dict[str, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self.by_id.values())
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self.by_id
+
+    def get(self, order_id: int) -> Optional[Dict[str, Any]]:
+        return self.by_id.get(order_id)
+
+    def for_user(self, user_id: int) -> List[Dict[str, Any]]:
+        return [self.by_id[oid] for oid in self.by_user.get(user_id, ())]
+
+    def with_status(self, status: str) -> List[Dict[str, Any]]:
+        return [self.by_id[oid] for oid in self.by_status.get(status, ())]
+
+    def _index(self, order: Dict[str, Any]):
+        oid = order["order_id"]
+        self.by_id[oid] = order
+        self.by_user.setdefault(order["user_id"], set()).add(oid)
+        self.by_status.setdefault(order["status"], set()).add(oid)
+
+    def _unindex_status(self, order: Dict[str, Any]):
+        ids = self.by_status.get(order["status"])
+        if ids is not None:
+            ids.discard(order["order_id"])
+            if not ids:
+                del self.by_status[order["status"]]
+
+    def load(self, orders: List[Dict[str, Any]]):
+        """Replace the contents with orders read from STORE (no write-back)."""
+        self.by_id.clear()
+        self.by_user.clear()
+        self.by_status.clear()
+        for order in orders:
+            order.setdefault("status", "pending")
+            self._index(order)
+
+    def add(self, order: Dict[str, Any]):
+        order.setdefault("status", "pending")
+        self._index(order)
+        save_order(self.kind, order)
+
+    def set_status(self, order_id: int, status: str):
+        order = self.by_id[order_id]
+        self._unindex_status(order)
+        order["status"] = status
+        self.by_status.setdefault(status, set()).add(order_id)
+        save_order(self.kind, order)
+
+    def remove(self, order_id: int) -> Optional[Dict[str, Any]]:
+        order = self.discard(order_id)
+        if order is not None:
+            drop_order(self.kind, order_id)
+        return order
+
+    # ---- coordinator mirror (refresh_mirror): changes read from STORE, no write-back ----
+
+    def apply(self, order: Dict[str, Any]):
+        """Insert or replace an order another process wrote (a replaced order keeps its queue position)."""
+        old = self.by_id.get(order["order_id"])
+        if old is not None:
+            self._unindex_status(old)
+        order.setdefault("status", "pending")
+        self._index(order)
+
+    def discard(self, order_id: int) -> Optional[Dict[str, Any]]:
+        """Drop an order from the indexes only."""
+        order = self.by_id.pop(order_id, None)
+        if order is None:
+            return None
+        ids = self.by_user[order["user_id"]]
+        ids.discard(order_id)
+        if not ids:
+            del self.by_user[order["user_id"]]
+        self._unindex_status(order)
+        return order
+
+
+class Leaderboard:
+    """
+    Users ordered by a score (highest first, ties by user id).
+    Only the best `keep` entries are kept sorted (`top`, always an exact prefix
+    of the full ranking), so update() is a dict write plus, for users at the
+    top, a binary search and an insert/delete in a list of at most `keep`.
+    A prefix that shrank below a requested page is refilled with one
+    heapq.nsmallest over the scores; pages deeper than `keep` are computed the
+    same way on demand (admin commands only).
+    rebuild() without items (boot) drops the scores; they are read from
+    `source()` on the first page, and update() is a no-op until then.
+    """
+
+    def __init__(self, source: Callable[[], Iterable[Tuple[int, int]]], keep: int = 1000):
+        self.source = source
+        self.keep = keep
+        self.scores: Optional[Dict[int, int]] = {}  # None = read from source() when first needed
+        self.top: List[Tuple[int, int]] = []  # (-score, user_id) ascending: the best len(top) users
+
+    def __len__(self) -> int:
+        return len(self._scores())
+
+    def rebuild(self, items: Optional[Iterable[Tuple[int, int]]] = None):
+        self.scores = None if items is None else dict(items)
+        self.top = []
+
+    def _scores(self) -> Dict[int, int]:
+        if self.scores is None:
+            self.scores = dict(self.source())
+        return self.scores
+
+    def _best(self, n: int) -> List[Tuple[int, int]]:
+        return heapq.nsmallest(n, ((-score, uid) for uid, score in self._scores().items()))
+
+    def update(self, user_id: int, score: int):
+        if self.scores is None:
+            return  # the deferred build reads the current score
+        old = self.scores.get(user_id)
+        if old == score:
+            return
+        self.scores[user_id] = score
+        top = self.top
+        if not top:
+            return  # refilled on the next page()
+        if old is not None:
+            key = (-old, user_id)
+            i = bisect_left(top, key)
+            if i < len(top) and top[i] == key:
+                del top[i]
+        # everyone outside `top` ranks below top[-1]: the user re-enters only ahead of it
+        if top and (-score, user_id) < top[-1]:
+            insort(top, (-score, user_id))
+            if len(top) > self.keep:
+                top.pop()
+
+    def page(self, offset: int, limit: int) -> List[Tuple[int, int]]:
+        """[(user_id, score), ...] for ranks offset+1 .. offset+limit."""
+        end = offset + limit
+        if end > self.keep:
+            ranked = self._best(end)
+        else:
+            if len(self.top) < min(end, len(self._scores())):
+                self.top = self._best(self.keep)
+            ranked = self.top
+        return [(uid, -neg) for neg, uid in ranked[offset:end]]
+
+
+class OwnerIndex:
+    """machine_no -> {user_id: expire_ts} for active machines; EXPIRY removes owners when due."""
+
+    def __init__(self):
+        self.owners: Dict[int, Dict[int, int]] = {}
+
+    def add(self, machine_no: int, user_id: int, expire_ts: int):
+        self.owners.setdefault(machine_no, {})[user_id] = expire_ts
+
+    def remove(self, machine_no: int, user_id: int):
+        self.owners.get(machine_no, {}).pop(user_id, None)
+
+    def count(self, machine_no: int) -> int:
+        return len(self.owners.get(machine_no, ()))
+
+    def page(self, machine_no: int, offset: int, limit: int) -> List[int]:
+        return list(islice(self.owners.get(machine_no, {}), offset, offset + limit))
+
+
+class MachineTimer:
+    """
+    Min-heap of (due_ts, user_id, machine_no). A single timer is armed for the
+    earliest entry and re-armed after each firing, so entries fire when due and
+    nothing rescans the users. Runs on the Application's job queue, or on
+    loop.call_later when the job-queue extra is not installed.
+    `on_due(entries, bot)` receives every entry that has come due; with `slack`
+    the timer fires that many seconds after the earliest entry, so entries due
+    close together are delivered in one call.
+    Entries are packed into one int each (~45 bytes instead of ~150 for a tuple)
+    so hundreds of thousands of pending timers stay cheap.
+    """
+
+    def __init__(self, on_due, name: str, slack: int = 0):
+        self.on_due = on_due
+        self.name = name
+        self.slack = slack
+        self._heap: List[int] = []  # due_ts << 64 | user_id << 8 | machine_no
+        self._app: Optional[Application] = None
+        self._handle = None  # Job or asyncio.TimerHandle
+        self._armed_at: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def add(self, due_ts: int, user_id: int, machine_no: int):
+        heapq.heappush(self._heap, due_ts << 64 | user_id << 8 | machine_no)
+        if self._app is not None and (self._armed_at is None or due_ts + self.slack < self._armed_at):
+            self._arm()
+
+    def add_many(self, entries: Iterable[Tuple[int, int, int]]):
+        """Queue (due_ts, user_id, machine_no) entries in bulk (boot): one heapify instead of a push each."""
+        self._heap.extend(due_ts << 64 | user_id << 8 | machine_no for due_ts, user_id, machine_no in entries)
+        heapq.heapify(self._heap)
+        if self._app is not None:
+            self._arm()
+
+    def start(self, application: Application):
+        self._app = application
+        if application.job_queue is None:
+            logger.warning("No job queue (install python-telegram-bot[job-queue]); %s runs on the event loop", self.name)
+        self._arm()
+
+    def stop(self):
+        self._disarm()
+        self._app = None
+
+    def _disarm(self):
+        if self._handle is not None:
+            if hasattr(self._handle, "schedule_removal"):
+                self._handle.schedule_removal()
+            else:
+                self._handle.cancel()
+        self._handle = None
+        self._armed_at = None
+
+    def _arm(self):
+        self._disarm()
+        if not self._heap:
+            return
+        self._armed_at = (self._heap[0] >> 64) + self.slack
+        delay = max(0.0, self._armed_at - time.time())
+        if self._app.job_queue is not None:
+            self._handle = self._app.job_queue.run_once(self._job_callback, delay, name=self.name)
+        else:
+            loop = asyncio.get_running_loop()
+            self._handle = loop.call_later(delay, lambda: self._app.create_task(self._fire()))
+
+    async def _job_callback(self, context: ContextTypes.DEFAULT_TYPE):
+        await self._fire()
+
+    async def _fire(self):
+        self._handle = None
+        self._armed_at = None
+        limit = (int(time.time()) + 1) << 64
+        due = []
+        while self._heap and self._heap[0] < limit:
+            key = heapq.heappop(self._heap)
+            due.append((key >> 64, key >> 8 & (1 << 56) - 1, key & 0xFF))
+        if self._app is not None:
+            self._arm()
+        if due:
+            await self.on_due(due, self._app.bot)
+
+
+# Working set lives in memory; changed records are queued on WRITER and
+# group-committed to STORE in the background (never on the handler's path).
+# Records are compact models.User objects with dict-style access.
+USERS: Dict[int, User] = {}
+MACHINE_ORDERS = OrderBook(MACHINE_ORDER)  # pending machine orders (wave pay)
+WITHDRAW_REQUESTS = OrderBook(WITHDRAW_ORDER)  # pending withdraw requests
+# Indexes only admin commands read are built on first use after boot (load_state), not at boot.
+USERNAME_INDEX: Dict[str, int] = {}  # lower-cased username -> user id, maintained by ensure_user; see username_index
+_username_index_built = True
+TOP_BALANCE = Leaderboard(lambda: ((uid, u.balance) for uid, u in USERS.items()))  # kept current by change_balance
+TOP_REFERRALS = Leaderboard(lambda: ((uid, u.referrals) for uid, u in USERS.items()))  # by credit_pending_referral
+TOP_PAGE_SIZE = 10
+MACHINE_OWNERS = OwnerIndex()  # kept current by install_machine / expire_machines
+DAILY_INCOME: Dict[int, int] = {}  # user id -> WCoin/day of active machines, same maintainers
+COLUMNS = open_columns(lambda: (column_row(uid, u) for uid, u in USERS.items()), ANALYTICS_COLUMNS)  # sync_columns
+OWNER_PAGE_SIZE = 50
+STORE = open_storage(DATABASE_PATH, STORAGE_BACKEND)
+WRITER = WriteBehind(STORE, USERS, flush_interval_ms=FLUSH_INTERVAL_MS, max_batch=FLUSH_MAX_BATCH)
+LEDGER = Ledger(LEDGER_PATH, checkpoint_every=LEDGER_CHECKPOINT_EVERY)
+BROADCASTER = Broadcaster(BROADCAST_STATE_PATH, chunk_size=BROADCAST_CHUNK, concurrency=BROADCAST_CONCURRENCY)
+EXPIRY = MachineTimer(lambda due, bot: expire_machines(due, bot), "machine-expiry")
+USER_LOCKS = KeyedLocks()  # held by handlers that check and then move a user's money / machines
+SEEN_QUERIES = RecentIds()  # callback query ids already handled
+REMINDERS = MachineTimer(lambda due, bot: send_claim_reminders(due, bot), "claim-reminders", slack=REMINDER_BATCH_SEC)
+METRICS = metrics.Metrics()  # per-handler latency and Bot API calls, installed by build_application
+_metrics_server = None
+
+
+def load_state():
+    """
+    Fill the in-memory structures from STORE (called once at boot).
+    Sharded: a worker loads its own users; the coordinator loads everyone, but
+    only its own users are live, the rest is a read mirror (see refresh_mirror).
+    One pass over the stored users fills what the handlers need (owners, daily
+    income, timers; the expiry heap is then built in bulk). The username
+    index, leaderboards and columns are only read by admin commands and are
+    built from USERS on first use. The loop is the restart cost, so it uses
+    User attributes (not u["..."]) and hoisted lookups.
+    """
+    global _mirror_since, _username_index_built
+    _mirror_since = time.time()
+    USERS.clear()
+    USERNAME_INDEX.clear()
+    _username_index_built = False
+    DAILY_INCOME.clear()
+    # the ledger is the source of truth; it may be ahead of the last group commit
+    ledger = LEDGER.replay() if LEDGER.enabled and LEDGER.has_checkpoint() else {}
+    now = int(time.time())
+    own_all = SHARDS <= 1
+    daily = {no: m["daily_wcoin"] for no, m in MACHINES.items()}
+    owners = {no: MACHINE_OWNERS.owners.setdefault(no, {}) for no in MACHINES}
+    expiry = []
+    # millions of new objects: the cyclic GC would rescan them over and over (as in SnapshotStorage._load)
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for u in STORE.load_users():
+            if type(u) is not User:  # SQLite rows and snapshots written before User
+                u = User.from_dict(u)
+            uid = u.id
+            if not (own_all or owns(uid)):
+                if SHARD != sharding.COORDINATOR:
+                    continue
+                mirror_user(u, rank=False)  # mirrored: timers run in the owning worker
+            else:
+                USERS[uid] = u
+                if ledger:
+                    bal = ledger.get(uid)
+                    if bal is not None and bal != u.balance:
+                        u.balance = bal
+                        save_user(uid)
+                held = u.machine_expiries()
+                if held:
+                    for _, exp in held:
+                        if exp <= now:
+                            # expired while the bot was down
+                            u["machines"] = [m for m in u.machines if m["expire_ts"] > now]
+                            save_user(uid)
+                            held = u.machine_expiries()
+                            break
+                    income = 0
+                    for no, exp in held:
+                        owners[no][uid] = exp
+                        expiry.append((exp, uid, no))
+                        income += daily[no]
+                    if income:
+                        DAILY_INCOME[uid] = income
+                    if u.claim_reminders:
+                        schedule_reminders(uid, u.machines)
+        load_orders()
+        if LEDGER.enabled and not LEDGER.has_checkpoint():
+            # first run with a ledger: the current balances become the baseline
+            LEDGER.checkpoint((uid, u["balance"]) for uid, u in USERS.items() if owns(uid))
+        EXPIRY.add_many(expiry)
+        TOP_BALANCE.rebuild()
+        TOP_REFERRALS.rebuild()
+        COLUMNS.rebuild()
+        del expiry
+        # the records live as long as the process: keep them out of every later collection too
+        # (otherwise the first collections after gc.enable() walk all of them)
+        gc.freeze()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    logger.info("Loaded %d users, %d machine orders, %d withdraw requests",
+                len(USERS), len(MACHINE_ORDERS), len(WITHDRAW_REQUESTS))
+
+
+def load_orders():
+    """Pending orders of this process's users (all of them in the coordinator's read view)."""
+    mine = (lambda o: True) if SHARD == sharding.COORDINATOR else (lambda o: owns(o["user_id"]))
+    MACHINE_ORDERS.load([o for o in STORE.load_orders(MACHINE_ORDER) if mine(o)])
+    WITHDRAW_REQUESTS.load([o for o in STORE.load_orders(WITHDRAW_ORDER) if mine(o)])
+
+
+def track_machine(user_id: int, m: Dict[str, Any]):
+    """Add an active machine to the owner / income aggregates and the expiry timer."""
+    MACHINE_OWNERS.add(m["machine_no"], user_id, m["expire_ts"])
+    DAILY_INCOME[user_id] = DAILY_INCOME.get(user_id, 0) + MACHINES[m["machine_no"]]["daily_wcoin"]
+    EXPIRY.add(m["expire_ts"], user_id, m["machine_no"])
+
+
+def column_row(user_id: int, u: Dict[str, Any]) -> Tuple[int, int, int, int, int]:
+    """The user's row in COLUMNS: id, balance, referrals, active machines bitmask, daily income."""
+    mask = income = 0
+    for no in u["machines"].column("machine_no"):
+        mask |= 1 << no
+        income += MACHINES[no]["daily_wcoin"]
+    return user_id, u["balance"], u["referrals"], mask, income
+
+
+def sync_columns(user_id: int):
+    """Call after changing a user's balance, referrals or machines."""
+    COLUMNS.set(*column_row(user_id, USERS[user_id]))
+
+
+def claim_ready_ts(m: Dict[str, Any]) -> int:
+    return m["last_claim_ts"] + MACHINES[m["machine_no"]]["claim_interval_sec"]
+
+
+def schedule_reminders(user_id: int, machines: Iterable[Dict[str, Any]]):
+    """Queue a claim reminder for each machine that is not claimable yet (opted-in users only)."""
+    now = int(time.time())
+    for m in machines:
+        ready = claim_ready_ts(m)
+        if now < ready < m["expire_ts"]:
+            REMINDERS.add(ready, user_id, m["machine_no"])
+
+
+async def send_claim_reminders(due: List[Tuple[int, int, int]], bot):
+    """REMINDERS callback: one message per user listing every machine that became claimable."""
+    now = int(time.time())
+    ready: Dict[int, Set[int]] = {}
+    for ts, uid, no in due:
+        u = USERS.get(uid)
+        if not u or not u.get("claim_reminders"):
+            continue
+        m = next((mi for mi in u["machines"] if mi["machine_no"] == no), None)
+        # stale entries: claimed since (ready moved on), expired, or re-bought
+        if m and claim_ready_ts(m) == ts and ts <= now:
+            ready.setdefault(uid, set()).add(no)
+
+    async def tell(uid: int, nos: Set[int]):
+        names = ", ".join(MACHINES[no]["key"] for no in sorted(nos))
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⚙️ စက်များ", callback_data="machines")]])
+        try:
+            await bot.send_message(uid, f"⛏ {names} စက်မှ Claim လုပ်နိုင်ပါပြီ!", reply_markup=kb,
+                                   rate_limit_args=BACKGROUND)
+        except Exception as e:
+            logger.warning("Claim reminder to %s failed: %s", uid, e)
+
+    await asyncio.gather(*(tell(uid, nos) for uid, nos in ready.items()))
+
+
+async def expire_machines(due: List[Tuple[int, int, int]], bot):
+    """EXPIRY callback: drop due machines from their owners and the aggregates, then notify."""
+    now = int(time.time())
+    notify = []
+    for uid in {uid for _, uid, _ in due}:
+        u = USERS.get(uid)
+        if not u:
+            continue
+        expired = [m for m in u["machines"] if m["expire_ts"] <= now]
+        if not expired:
+            continue
+        u["machines"] = [m for m in u["machines"] if m["expire_ts"] > now]
+        for m in expired:
+            MACHINE_OWNERS.remove(m["machine_no"], uid)
+            DAILY_INCOME[uid] -= MACHINES[m["machine_no"]]["daily_wcoin"]
+        sync_columns(uid)
+        save_user(uid)
+        recent = [MACHINES[m["machine_no"]]["key"] for m in expired if now - m["expire_ts"] < EXPIRY_NOTIFY_MAX_AGE]
+        if EXPIRY_NOTIFY and recent:
+            notify.append((uid, ", ".join(recent)))
+
+    async def tell(uid: int, names: str):
+        try:
+            await bot.send_message(uid, f"⏰ {names} စက် သက်တမ်းကုန်သွားပါပြီ။", rate_limit_args=BACKGROUND)
+        except Exception as e:
+            logger.warning("Expiry notification to %s failed: %s", uid, e)
+
+    await asyncio.gather(*(tell(uid, names) for uid, names in notify))
+
+
+def save_user(*user_ids: int):
+    """Mark user records dirty; WRITER persists them with the next group commit."""
+    for uid in user_ids:
+        if not owns(uid):
+            # only the owning worker writes a user's row; changes go through run_on_owner
+            logger.warning("Not saving user %s: owned by shard %s", uid, shard_of(uid))
+            continue
+        WRITER.mark_user(uid)
+
+
+def save_order(kind: str, order: Dict[str, Any]):
+    WRITER.put_order(kind, order)
+
+
+def drop_order(kind: str, order_id: int):
+    WRITER.delete_order(kind, order_id)
+
+
+_last_order_id = 0
+
+
+def next_order_id() -> int:
+    """
+    Millisecond timestamp, bumped if two orders are created in the same millisecond.
+    Sharded: times 1000 plus the shard number, so processes never hand out the same id.
+    """
+    global _last_order_id
+    if SHARDS > 1:
+        _last_order_id = max(int(time.time() * 1000) * 1000 + SHARD % 1000, _last_order_id + 1000)
+    else:
+        _last_order_id = max(int(time.time() * 1000), _last_order_id + 1)
+    return _last_order_id
+
+
+def change_balance(user_id: int, amount: int, kind: int) -> int:
+    """Credit (amount > 0) or debit a user through the ledger; returns the new balance."""
+    u = USERS[user_id]
+    u["balance"] += amount
+    LEDGER.append(user_id, kind, amount, u["balance"])
+    TOP_BALANCE.update(user_id, u["balance"])
+    sync_columns(user_id)
+    save_user(user_id)
+    return u["balance"]
+
+
+async def sync_ledger():
+    """
+    Runs before every group commit, once its rows are encoded, so the ledger
+    reaches disk (fsync) ahead of the balances it explains. Idle: no fsync.
+    """
+    if not LEDGER.enabled:
+        return
+    loop = asyncio.get_running_loop()
+    if LEDGER.unsynced():
+        await loop.run_in_executor(None, LEDGER.sync)
+    if LEDGER.checkpoint_due():
+        balances = [(uid, u["balance"]) for uid, u in USERS.items() if owns(uid)]
+        await loop.run_in_executor(None, LEDGER.checkpoint, balances, LEDGER.seq, LEDGER.size)
+
+
+WRITER.before_flush.append(sync_ledger)
+
+
+# ---------------- SHARDING ----------------
+# Unsharded (the default) every user is owned by this process and the ops run
+# in place. Under sharding.py each non-admin user belongs to one worker
+# (user_id % SHARDS) and admins to the coordinator; state of a user that lives
+# elsewhere is only changed by sending an op to its owner.
+
+
+def shard_of(user_id: int) -> int:
+    return sharding.shard_for(user_id, SHARDS, ADMIN_USER_IDS)
+
+
+def owns(user_id: int) -> bool:
+    return SHARDS <= 1 or shard_of(user_id) == SHARD
+
+
+def user_known(user_id: int) -> bool:
+    return user_id in USERS or (not owns(user_id) and STORE.user_exists(user_id))
+
+
+_mirror_since = 0.0
+MIRROR_OVERLAP = 5.0  # seconds re-read on every refresh: a worker's commit can land after the row's timestamp
+
+
+def mirror_user(u: Dict[str, Any], rank: bool = True):
+    """Coordinator: replace the read copy of a worker's user and re-index it (rank=False: boot, boards and columns rebuilt after)."""
+    u = User.from_dict(u)
+    uid = u["id"]
+    old = USERS.get(uid)
+    if old:
+        for m in old["machines"]:
+            MACHINE_OWNERS.remove(m["machine_no"], uid)
+        name = old["username"].lower()
+        if USERNAME_INDEX.get(name) == uid:
+            del USERNAME_INDEX[name]
+    now = time.time()
+    u["machines"] = [m for m in u["machines"] if m["expire_ts"] > now]
+    USERS[uid] = u
+    if u.get("username"):
+        USERNAME_INDEX[u["username"].lower()] = uid
+    for m in u["machines"]:
+        MACHINE_OWNERS.add(m["machine_no"], uid, m["expire_ts"])
+    if rank:
+        TOP_BALANCE.update(uid, u["balance"])
+        TOP_REFERRALS.update(uid, u["referrals"])
+        sync_columns(uid)
+
+
+async def refresh_mirror(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Coordinator, before every update: pull the users and orders the workers
+    committed since last time. Only deltas are applied, and only for users the
+    coordinator does not own: its own orders stay as they are in memory, even
+    before their group commit.
+    """
+    global _mirror_since
+    now = time.time()
+    since = _mirror_since - MIRROR_OVERLAP
+    for u in STORE.load_users_since(since):
+        if not owns(u["id"]):
+            mirror_user(u)
+    books = {MACHINE_ORDER: MACHINE_ORDERS, WITHDRAW_ORDER: WITHDRAW_REQUESTS}
+    changed, deleted = STORE.load_orders_since(since)
+    for kind, order in changed:
+        if kind in books and not owns(order["user_id"]):
+            books[kind].apply(order)
+    for kind, order_id in deleted:
+        order = books[kind].get(order_id) if kind in books else None
+        if order is not None and not owns(order["user_id"]):
+            books[kind].discard(order_id)
+    _mirror_since = now
+
+
+async def run_on_owner(bot, user_id: int, op: str, *args):
+    """Run SHARD_OPS[op](bot, *args) in the process that owns `user_id`."""
+    if owns(user_id):
+        await SHARD_OPS[op](bot, *args)
+    else:
+        sharding.send_op(shard_of(user_id), op, args)
+
+
+async def run_shard_op(bot, op: str, args: tuple):
+    """An op sent by another process (see sharding.serve)."""
+    try:
+        await SHARD_OPS[op](bot, *args)
+    except Exception:
+        logger.exception("Shard op %s%r failed", op, args)
+
+
+async def op_grant(bot, user_id: int, amount: int):
+    async with USER_LOCKS(user_id):
+        if user_id in USERS:
+            change_balance(user_id, amount, ADMIN_GRANT)
+
+
+async def op_skip(bot, user_id: int):
+    if user_id in USERS:
+        USERS[user_id]["skip_verified"] = True
+        save_user(user_id)
+
+
+async def op_withdraw_status(bot, order_id: int, status: str):
+    if order_id in WITHDRAW_REQUESTS:
+        WITHDRAW_REQUESTS.set_status(order_id, status)
+
+
+async def op_mark_blocked(bot, user_id: int):
+    if user_id in USERS:
+        # prune: later broadcasts skip the user until they talk to the bot again
+        USERS[user_id]["blocked"] = True
+        save_user(user_id)
+
+
+async def op_credit_referrer(bot, ref: int):
+    """Referral bonus for the inviter (the new user is credited by their own process)."""
+    async with USER_LOCKS(ref):
+        if ref not in USERS:
+            return
+        change_balance(ref, 3000, REFERRAL)
+        USERS[ref]["referrals"] += 1
+        TOP_REFERRALS.update(ref, USERS[ref]["referrals"])
+        sync_columns(ref)
+        save_user(ref)
+        balance = USERS[ref]["balance"]
+    # notify inviter
+    try:
+        await bot.send_message(ref, f"🎉 သင့်ဖိတ်ခေါ်မှုမှ အသစ်တစ်ဦး ဝင်လာပြီး WCoin 3000 ရရှိပါပြီ!\nBalance: {balance}",
+                               rate_limit_args=BACKGROUND)
+    except Exception as e:
+        logger.warning("Referral notification to %s failed: %s", ref, e)
+
+
+async def op_settle_withdraw(bot, admin_chat: int, payload: Dict[str, Any], file_id: str):
+    """Admin sent the receipt for a withdraw order: deduct, post to the payout channel, notify."""
+    target = payload["user_id"]
+    amt = payload["amount"]
+    async with USER_LOCKS(target):
+        # remove from queue first: a second receipt for the same order must not deduct again
+        if WITHDRAW_REQUESTS.remove(payload["order_id"]) is None:
+            return await bot.send_message(admin_chat, "Order already processed")
+        # deduct balance if available
+        if USERS.get(target) and USERS[target]["balance"] >= amt:
+            change_balance(target, -amt, WITHDRAW)
+    # post to payout channel and notify user
+    try:
+        await bot.send_photo(PAYOUT_HISTORY_CHANNEL, file_id, caption=f"order id: {payload['order_id']}, user: {payload['user_id']}, amount: {payload['amount']}, date: {payload['created_at']}",
+                             rate_limit_args=BACKGROUND)
+    except Exception as e:
+        logger.warning("Payout post for order %s failed: %s", payload["order_id"], e)
+    try:
+        await bot.send_message(target, f"သင့်ငွေထုတ် {amt} ကို ပြီးစီးပါပြီ", rate_limit_args=BACKGROUND)
+    except Exception as e:
+        logger.warning("Withdraw notification to %s failed: %s", target, e)
+    await bot.send_message(admin_chat, "✅ အောင်မြင်ပါပြီ")
+
+
+async def op_approve_machine(bot, admin_chat: int, order_id: int):
+    """Admin confirmed a WavePay machine order: install the machine."""
+    rec = MACHINE_ORDERS.get(order_id)
+    if not rec:
+        return await bot.send_message(admin_chat, "Order not found")
+    uid = rec["user_id"]
+    async with USER_LOCKS(uid):
+        if not can_buy_machine_now(uid, rec["machine_no"]):
+            return await bot.send_message(admin_chat, "User already owns this machine (active), cannot add.")
+        install_machine(uid, rec["machine_no"], method="wave")
+        MACHINE_ORDERS.remove(order_id)
+    try:
+        await bot.send_message(uid, f"Order ID {order_id} အောင်မြင်ပါပြီ ✅\n{MACHINES[rec['machine_no']]['key']} စက် ပေါင်းထည့်ပြီးပါပြီ။",
+                               rate_limit_args=BACKGROUND)
+    except Exception as e:
+        logger.warning("Order notification to %s failed: %s", uid, e)
+    await bot.send_message(admin_chat, "Done")
+
+
+SHARD_OPS = {
+    "grant": op_grant,
+    "skip": op_skip,
+    "withdraw_status": op_withdraw_status,
+    "mark_blocked": op_mark_blocked,
+    "credit_referrer": op_credit_referrer,
+    "settle_withdraw": op_settle_withdraw,
+    "approve_machine": op_approve_machine,
+}
+
+
 # ---------------- HELPERS ----------------
 
 
 def ensure_user(user_id: int, username: Optional[str] = None) -> Dict[str, Any]:
     u = USERS.get(user_id)
+    if u and username and u["username"] != username:
+        # Telegram username changed (or was set) since we last saw the user
+        set_username(u, username)
+    if u and u.get("blocked"):
+        # the user is talking to the bot again, so broadcasts reach them again
+        u["blocked"] = False
+        save_user(user_id)
     if not u:
-        USERS[user_id] = {
-            "id": user_id,
-            "username": username or f"user{user_id}",
-            "balance": 0,
-            "referrals": 0,
-            "referred_by": None,
-            "referral_credited": False,
-            "machines": [],  # list of dicts: {machine_no, buy_ts, expire_ts, last_claim_ts, method}
-            "withdraw_account": None,
-            "withdraw_fail_count": 0,
-            "awaiting": None,  # expecting 'phone','amount','transfer_no','admin_caption', etc.
-            "pending_order": None,  # temp holder for machine purchase
-            "skip_verified": False,
-        }
-        u = USERS[user_id]
+        # machines: {machine_no, buy_ts, expire_ts, last_claim_ts, method} rows (see models.py)
+        # awaiting: expecting 'phone','amount','transfer_no','admin_caption', etc.
+        # pending_order: temp holder for machine purchase
+        u = USERS[user_id] = User(user_id, username or f"user{user_id}")
+        USERNAME_INDEX[u["username"].lower()] = user_id
+        TOP_BALANCE.update(user_id, 0)
+        TOP_REFERRALS.update(user_id, 0)
+        sync_columns(user_id)
+        save_user(user_id)
     return u
 
 
+def set_username(u: Dict[str, Any], username: str):
+    old = u["username"].lower()
+    if USERNAME_INDEX.get(old) == u["id"]:
+        del USERNAME_INDEX[old]
+    u["username"] = username
+    USERNAME_INDEX[username.lower()] = u["id"]
+    save_user(u["id"])
+
+
+def username_index() -> Dict[str, int]:
+    """USERNAME_INDEX, built from USERS on the first lookup after load_state (writes before that are redone)."""
+    global _username_index_built
+    if not _username_index_built:
+        USERNAME_INDEX.clear()
+        for uid, u in USERS.items():
+            if u.username:
+                USERNAME_INDEX[u.username.lower()] = uid
+        _username_index_built = True
+    return USERNAME_INDEX
+
+
+def resolve_user(who: str) -> Optional[int]:
+    """Resolve an admin argument (user id or @username, any case) to a known user id."""
+    if who.isdigit():
+        uid = int(who)
+        return uid if uid in USERS else None
+    return username_index().get(who.lstrip("@").lower())
+
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_USER_IDS
 
@@ -138,18 +952,115 @@ def bot_username(context: ContextTypes.DEFAULT_TYPE) -> str:
     return context.bot.username
 
 
-def has_joined_all_channels(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    """Check membership; return False if bot cannot verify or user not joined."""
-    bot = context.bot
-    try:
-        for ch in REQUIRED_CHANNELS:
-            member = bot.get_chat_member(ch, user_id)
-            if member.status not in ("member", "administrator", "creator"):
-                return False
+JOINED_STATUSES = ("member", "administrator", "creator")
+
+
+def channel_key(name: str) -> str:
+    return name.lower()
+
+
+# Local membership table: channel -> {user_id: (joined, expires_at)}, LRU order,
+# bounded by MEMBERSHIP_CACHE_SIZE. chat_member updates write long-lived entries
+# (MEMBERSHIP_EVENT_TTL) for the bot's users; polling (cold start, or when the
+# bot gets no chat_member updates) writes short ones.
+CHANNEL_MEMBERS: Dict[str, "OrderedDict[int, Tuple[bool, float]]"] = {
+    channel_key(ch): OrderedDict() for ch in REQUIRED_CHANNELS}
+_membership_inflight: Dict[int, "asyncio.Future[bool]"] = {}
+
+
+def is_joined(member) -> bool:
+    return member.status in JOINED_STATUSES or (member.status == "restricted" and member.is_member)
+
+
+def record_membership(channel: str, user_id: int, joined: bool, ttl: float):
+    members = CHANNEL_MEMBERS[channel_key(channel)]
+    members[user_id] = (joined, time.monotonic() + ttl)
+    members.move_to_end(user_id)
+    if len(members) > MEMBERSHIP_CACHE_SIZE:
+        members.popitem(last=False)
+
+
+async def _poll_membership(bot, user_id: int, channels: List[str]) -> bool:
+    """Ask Telegram about the given channels at once and record the answers."""
+    results = await asyncio.gather(
+        *(bot.get_chat_member(ch, user_id) for ch in channels), return_exceptions=True
+    )
+    joined_all = True
+    for ch, member in zip(channels, results):
+        if isinstance(member, Exception):
+            logger.warning("Membership check failed for %s: %s", ch, member)
+            record_membership(ch, user_id, False, MEMBERSHIP_NEGATIVE_TTL)
+            joined_all = False
+            continue
+        joined = is_joined(member)
+        record_membership(ch, user_id, joined, MEMBERSHIP_TTL if joined else MEMBERSHIP_NEGATIVE_TTL)
+        joined_all = joined_all and joined
+    return joined_all
+
+
+async def has_joined_all_channels(context: ContextTypes.DEFAULT_TYPE, user_id: int, fresh: bool = False) -> bool:
+    """
+    Check membership; return False if bot cannot verify or user not joined.
+    Answered from CHANNEL_MEMBERS; only channels without a current entry are
+    polled, and concurrent checks for the same user share one poll.
+    fresh=True polls every channel (the user says they just joined).
+    """
+    now = time.monotonic()
+    unknown = []
+    for ch in REQUIRED_CHANNELS:
+        hit = CHANNEL_MEMBERS[channel_key(ch)].get(user_id)
+        if fresh or hit is None or hit[1] <= now:
+            unknown.append(ch)
+        elif not hit[0]:
+            return False
+    if not unknown:
         return True
+    pending = _membership_inflight.get(user_id)
+    if pending is not None:
+        return await pending
+    fut = asyncio.get_running_loop().create_future()
+    _membership_inflight[user_id] = fut
+    try:
+        joined = await _poll_membership(context.bot, user_id, unknown)
+        fut.set_result(joined)
+        return joined
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
     except Exception as e:
-        logger.warning("Membership check failed: %s", e)
-        return False
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved when nobody else is waiting
+        raise
+    finally:
+        del _membership_inflight[user_id]
+
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep CHANNEL_MEMBERS current from join/leave events (bot must be channel admin)."""
+    cmu = update.chat_member
+    chat = cmu.chat
+    key = channel_key(f"@{chat.username}") if chat.username else str(chat.id)
+    if key not in CHANNEL_MEMBERS:
+        key = str(chat.id)
+        if key not in CHANNEL_MEMBERS:
+            return
+    member = cmu.new_chat_member
+    if member.user.id not in USERS:
+        return  # not a bot user (yet): their first check polls
+    record_membership(key, member.user.id, is_joined(member), MEMBERSHIP_EVENT_TTL)
+
+
+async def warm_membership(application: Application):
+    """Cold-start fallback: poll the newest users once so their first click is answered locally."""
+    users = list(islice((uid for uid in reversed(USERS) if owns(uid)), MEMBERSHIP_WARM_USERS))
+    sem = asyncio.Semaphore(MEMBERSHIP_WARM_CONCURRENCY)
+
+    async def warm(uid: int):
+        async with sem:
+            await _poll_membership(application.bot, uid, REQUIRED_CHANNELS)
+
+    await asyncio.gather(*(warm(uid) for uid in users), return_exceptions=True)
+    logger.info("Membership warmed for %d users", len(users))
 
 
 def build_main_menu():
@@ -190,10 +1101,11 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if ref != user.id:
                 USERS[user.id]["referred_by"] = ref
                 USERS[user.id]["referral_credited"] = False
+                save_user(user.id)
         except Exception:
             pass
 
-    if not has_joined_all_channels(context, user.id):
+    if not await has_joined_all_channels(context, user.id):
         return await send_join_gate(update, context)
     # if joined -> possibly credit referral
     await credit_pending_referral(user.id, context)
@@ -204,7 +1116,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def confirm_join_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     user_id = q.from_user.id
-    if not has_joined_all_channels(context, user_id):
+    if not await has_joined_all_channels(context, user_id, fresh=True):
         await q.answer("Channel မဝင်ရသေးပါ", show_alert=True)
         return
     await q.answer()
@@ -220,28 +1132,35 @@ async def credit_pending_referral(new_user_id: int, context: ContextTypes.DEFAUL
     if u.get("referral_credited"):
         return
     ref = u.get("referred_by")
-    if not ref or ref == new_user_id or ref not in USERS:
+    if not ref or ref == new_user_id or not user_known(ref):
         return
-    # credit both
-    USERS[ref]["balance"] += 3000
-    USERS[ref]["referrals"] += 1
-    u["balance"] += 3000
+    # credit both (the inviter in their own process when sharded)
+    change_balance(new_user_id, 3000, REFERRAL)
     u["referral_credited"] = True
-    # notify inviter
-    try:
-        await context.bot.send_message(ref, f"🎉 သင့်ဖိတ်ခေါ်မှုမှ အသစ်တစ်ဦး ဝင်လာပြီး WCoin 3000 ရရှိပါပြီ!\nBalance: {USERS[ref]['balance']}")
-    except Exception:
-        pass
+    save_user(new_user_id)
+    await run_on_owner(context.bot, ref, "credit_referrer", ref)
+
+
+# callback data handled below, without the numeric argument (metrics labels, see metrics.py)
+CALLBACK_ACTIONS = ("confirm_join", "claim_all", "balance", "invite", "buy_machine", "machines", "withdraw",
+                    "catalog", "owned", "reminders", "buy", "premium_wcoin", "premium_wave", "claim",
+                    "change_withdraw_account", "confirm_withdraw_account", "cancel_withdraw", "cancel_purchase")
 
 
 async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
+    if not SEEN_QUERIES.add(q.id):
+        return  # same query delivered again (e.g. re-fetched after a restart)
     data = q.data
     uid = q.from_user.id
     ensure_user(uid, q.from_user.username)
+    if data == "confirm_join":
+        return await confirm_join_cb(update, context)
     # Guard: require channel join for all menu actions
-    if not has_joined_all_channels(context, uid):
+    if not await has_joined_all_channels(context, uid):
         return await send_join_gate(update, context)
+    if data == "claim_all":  # answers the query itself (alert when nothing is ready yet)
+        return await handle_claim_all(q, context)
 
     await q.answer()
     if data == "balance":
@@ -254,6 +1173,16 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await machines_menu(q, context)
     if data == "withdraw":
         return await withdraw_menu(q, context)
+    # menu pages: catalog:{page} / owned:{page} / reminders:{page}; anything else is ignored
+    action, _, arg = data.partition(":")
+    if action in ("catalog", "owned", "reminders") and not arg.isdecimal():
+        return
+    if action == "catalog":
+        return await buy_machine_menu(q, context, int(arg))
+    if action == "owned":
+        return await machines_menu(q, context, int(arg))
+    if action == "reminders":  # opt in/out of claim reminders
+        return await toggle_reminders(q, context, int(arg))
     # machine purchase callbacks
     if data.startswith("buy_"):  # buy_{machine_no}
         return await handle_buy_click(q, context, data)
@@ -303,38 +1232,65 @@ async def invite_cb(q, context: ContextTypes.DEFAULT_TYPE):
     await q.message.edit_text(text)
 
 
-async def buy_machine_menu(q, context: ContextTypes.DEFAULT_TYPE):
-    uid = q.from_user.id
+def page_slice(page: int):
+    """Machine numbers on a 1-based menu page, plus the page count."""
+    nos = sorted(MACHINES.keys())
+    pages = max(1, -(-len(nos) // CATALOG_PAGE_SIZE))
+    page = min(max(1, page), pages)
+    return nos[(page - 1) * CATALOG_PAGE_SIZE:page * CATALOG_PAGE_SIZE], page, pages
+
+
+def pager_row(prefix: str, page: int, pages: int) -> List[InlineKeyboardButton]:
+    row = []
+    if page > 1:
+        row.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}:{page - 1}"))
+    if page < pages:
+        row.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}:{page + 1}"))
+    return row
+
+
+async def edit_in_place(q, text: str, reply_markup=None):
+    try:
+        await q.message.edit_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # re-opening the page that is already shown
+        if "not modified" not in str(e).lower():
+            raise
+
+
+def render_catalog(uid: int, page: int = 1):
+    """The whole buy menu (or one page of it) as a single text + keyboard."""
     u = USERS[uid]
-    now = int(time.time())
-    
-    # Send a single introductory message first
-    await q.message.edit_text("⚒️ စက်ဝယ်ယူရန် မီနူး")
-    
-    for idx in sorted(MACHINES.keys()):
+    nos, page, pages = page_slice(page)
+    blocks = ["⚒️ စက်ဝယ်ယူရန် မီနူး"]
+    buttons = []
+    for idx in nos:
         m = MACHINES[idx]
-        owned = any(mi["machine_no"] == idx and mi["expire_ts"] > now for mi in u["machines"])
+        owned = any(mi["machine_no"] == idx for mi in u["machines"])
         caption = (
             f"⚙️ စက်အမည်: {m['key']}\n"
             f"⛏ တူးနှုန်း: {m['daily_wcoin']} WCoin/ရက်\n"
-            f"📅 Expire after: {m['expire_days']} days\n"
+            f"📅 Expire after: {m['expire_days']} days"
         )
-        buttons = []
         if owned:
             caption += "\n✅ သင်ပိုင်ဆိုင်ထားပါသည်"
         else:
             if idx == 4:  # Premium - two payment methods
-                buttons.append([InlineKeyboardButton("WCoin ဖြင့်ဝယ်မည်", callback_data="premium_wcoin")])
-                buttons.append([InlineKeyboardButton("Wave Pay ဖြင့်ဝယ်မည်", callback_data="premium_wave")])
+                buttons.append([InlineKeyboardButton(f"{m['key']} - WCoin ဖြင့်ဝယ်မည်", callback_data="premium_wcoin")])
+                buttons.append([InlineKeyboardButton(f"{m['key']} - Wave Pay ဖြင့်ဝယ်မည်", callback_data="premium_wave")])
             else:
                 price = m["price_mmk"]
-                buttons.append([InlineKeyboardButton(f"Price: {price} MMK", callback_data=f"buy_{idx}")])
-        
-        await context.bot.send_message(
-            chat_id=q.message.chat_id, 
-            text=caption, 
-            reply_markup=InlineKeyboardMarkup(buttons) if buttons else None
-        )
+                buttons.append([InlineKeyboardButton(f"{m['key']} - Price: {price} MMK", callback_data=f"buy_{idx}")])
+        blocks.append(caption)
+    nav = pager_row("catalog", page, pages)
+    if nav:
+        buttons.append(nav)
+    return "\n\n".join(blocks), InlineKeyboardMarkup(buttons) if buttons else None
+
+
+async def buy_machine_menu(q, context: ContextTypes.DEFAULT_TYPE, page: int = 1):
+    text, kb = render_catalog(q.from_user.id, page)
+    await edit_in_place(q, text, kb)
 
 
 async def handle_buy_click(q, context: ContextTypes.DEFAULT_TYPE, data: str):
@@ -355,7 +1311,7 @@ async def handle_buy_click(q, context: ContextTypes.DEFAULT_TYPE, data: str):
         return
     
     order = {
-        "order_id": int(time.time() * 1000),
+        "order_id": next_order_id(),
         "user_id": uid,
         "machine_no": machine_no,
         "price_mmk": m['price_mmk'],
@@ -363,6 +1319,7 @@ async def handle_buy_click(q, context: ContextTypes.DEFAULT_TYPE, data: str):
         "created_at": datetime.now().isoformat(),
     }
     USERS[uid]["pending_order"] = order
+    save_user(uid)
     await q.message.edit_text(
         "သင့်အတွက် ငွေလွှဲအော်ဒါ\n\n"
         "ငွေလွှဲရန် အချက်အလက်⬇️\n"
@@ -381,19 +1338,20 @@ async def handle_premium_choice(q, context: ContextTypes.DEFAULT_TYPE, data: str
     uid = q.from_user.id
     ensure_user(uid)
     if data == "premium_wcoin":
-        price = MACHINES[4]["price_wcoin"]
-        if USERS[uid]["balance"] >= price:
-            if can_buy_machine_now(uid, 4):
-                USERS[uid]["balance"] -= price
-                install_machine(uid, 4, method="wcoin")
-                await q.message.edit_text("Premium Machine ကို WCoin ဖြင့် အောင်မြင်စွာ ဝယ်ယူပြီးပါပြီ ✅")
+        async with USER_LOCKS(uid):
+            price = MACHINES[4]["price_wcoin"]
+            if USERS[uid]["balance"] >= price:
+                if can_buy_machine_now(uid, 4):
+                    change_balance(uid, -price, PURCHASE)
+                    install_machine(uid, 4, method="wcoin")  # persists the user
+                    await q.message.edit_text("Premium Machine ကို WCoin ဖြင့် အောင်မြင်စွာ ဝယ်ယူပြီးပါပြီ ✅")
+                else:
+                    await q.message.edit_text("❌ ဒီစက်ကို 30 ရက်အတွင်း တစ်ခါထပ်ဝယ်လို့ မရပါ။")
             else:
-                await q.message.edit_text("❌ ဒီစက်ကို 30 ရက်အတွင်း တစ်ခါထပ်ဝယ်လို့ မရပါ။")
-        else:
-            await q.message.edit_text("Balance မလုံလောက်ပါ ❌")
+                await q.message.edit_text("Balance မလုံလောက်ပါ ❌")
     elif data == "premium_wave":
         order = {
-            "order_id": int(time.time() * 1000),
+            "order_id": next_order_id(),
             "user_id": uid,
             "machine_no": 4,
             "price_mmk": MACHINES[4]["price_mmk"],
@@ -401,6 +1359,7 @@ async def handle_premium_choice(q, context: ContextTypes.DEFAULT_TYPE, data: str
             "created_at": datetime.now().isoformat(),
         }
         USERS[uid]["pending_order"] = order
+        save_user(uid)
         await q.message.edit_text(
             "Premium (Wave Pay) — ငွေလွှဲနံပါတ် ပို့ပါ။\n\n(10 မိနစ်အတွင်း screenshot ပို့ပါ)",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data="cancel_purchase")]]),
@@ -409,31 +1368,32 @@ async def handle_premium_choice(q, context: ContextTypes.DEFAULT_TYPE, data: str
 
 def can_buy_machine_now(user_id: int, machine_no: int) -> bool:
     """Return False if user already owns active machine of same type"""
-    now = int(time.time())
-    for mi in USERS[user_id]["machines"]:
-        if mi["machine_no"] == machine_no and mi["expire_ts"] > now:
-            return False
-    return True
+    return not any(mi["machine_no"] == machine_no for mi in USERS[user_id]["machines"])
 
 
 def install_machine(user_id: int, machine_no: int, method: str = "wave"):
     now = int(time.time())
     exp = now + MACHINES[machine_no]["expire_days"] * 86400
-    USERS[user_id]["machines"].append(
-        {
-            "machine_no": machine_no,
-            "buy_ts": now,
-            "expire_ts": exp,
-            "last_claim_ts": now,
-            "method": method,
-        }
-    )
+    m = {
+        "machine_no": machine_no,
+        "buy_ts": now,
+        "expire_ts": exp,
+        "last_claim_ts": now,
+        "method": method,
+    }
+    USERS[user_id]["machines"].append(m)
+    track_machine(user_id, m)
+    sync_columns(user_id)
+    if USERS[user_id].get("claim_reminders"):
+        schedule_reminders(user_id, [m])
+    save_user(user_id)
 
 
 async def cancel_purchase_cb(q, context: ContextTypes.DEFAULT_TYPE):
     uid = q.from_user.id
     if USERS[uid].get("pending_order"):
         USERS[uid]["pending_order"] = None
+        save_user(uid)
     await q.message.edit_text("စက်ဝယ်ခြင်းလုပ်ငန်းစဉ်ကို ဖျက်ပြီးပါပြီ။")
 
 
@@ -452,6 +1412,7 @@ async def text_message_router(update: Update, context: ContextTypes.DEFAULT_TYPE
         if po["step"] == "await_transfer_no":
             po["transfer_no"] = text
             po["step"] = "await_screenshot"
+            save_user(user.id)
             await update.message.reply_text("Transfer number သိရှိပါပြီ။ သင်၏ payment screenshot ကို ပို့ပါ။")
             return
         if po["step"] == "await_screenshot":
@@ -463,6 +1424,7 @@ async def text_message_router(update: Update, context: ContextTypes.DEFAULT_TYPE
     if u.get("awaiting") == "withdraw_account":
         u["withdraw_account"] = text
         u["awaiting"] = None
+        save_user(user.id)
         await update.message.reply_text(f"သင့်ငွေထုတ်အကောင့်အနေနဲ့ {text} ကို သိမ်းဆည်းပြီးပါပြီ။")
         return
 
@@ -471,32 +1433,36 @@ async def text_message_router(update: Update, context: ContextTypes.DEFAULT_TYPE
         if not text.replace(",", "").isdigit():
             await update.message.reply_text("ပမာဏမှန်ကန်စွာ ထည့်ပါ")
             return
-        amt = int(text.replace(",", ""))
-        if amt > u["balance"]:
-            u["withdraw_fail_count"] = u.get("withdraw_fail_count", 0) + 1
-            await update.message.reply_text("ငွေမလောက်ပါ")
-            if u["withdraw_fail_count"] >= 2:
-                u["awaiting"] = None
-                u["withdraw_fail_count"] = 0
-                await update.message.reply_text("ငွေထုတ် logic ကို ရပ်ထားလိုက်ပါသည်")
-            return
-        if amt < 50000:
-            await update.message.reply_text("အနည်းဆုံး50000ကျပ်သာထုတ်နိုင်ပါသည်")
-            return
-        # create withdraw order
-        order_id = int(time.time() * 1000)
-        WITHDRAW_REQUESTS.append(
-            {
+        async with USER_LOCKS(user.id):
+            if u.get("awaiting") != "withdraw_amount":
+                return  # a concurrent message already completed the request
+            amt = int(text.replace(",", ""))
+            if amt > u["balance"]:
+                u["withdraw_fail_count"] = u.get("withdraw_fail_count", 0) + 1
+                await update.message.reply_text("ငွေမလောက်ပါ")
+                if u["withdraw_fail_count"] >= 2:
+                    u["awaiting"] = None
+                    u["withdraw_fail_count"] = 0
+                    await update.message.reply_text("ငွေထုတ် logic ကို ရပ်ထားလိုက်ပါသည်")
+                save_user(user.id)
+                return
+            if amt < 50000:
+                await update.message.reply_text("အနည်းဆုံး50000ကျပ်သာထုတ်နိုင်ပါသည်")
+                return
+            # create withdraw order
+            order_id = next_order_id()
+            req = {
                 "order_id": order_id,
                 "user_id": user.id,
                 "amount": amt,
                 "account": u.get("withdraw_account"),
                 "created_at": datetime.now().isoformat(),
             }
-        )
-        u["awaiting"] = None
-        await update.message.reply_text("admin သို့ ပို့လိုက်ပါပြီ ခနစောင့်ပါ")
-        return
+            WITHDRAW_REQUESTS.add(req)
+            u["awaiting"] = None
+            save_user(user.id)
+            await update.message.reply_text("admin သို့ ပို့လိုက်ပါပြီ ခနစောင့်ပါ")
+            return
 
     # Admin caption for /Add_B y
     if is_admin(user.id) and u.get("awaiting") == "admin_add_caption":
@@ -506,10 +1472,12 @@ async def text_message_router(update: Update, context: ContextTypes.DEFAULT_TYPE
             target = payload["target"]
             amt = payload["amount"]
             try:
-                await context.bot.send_message(target, (caption + "\n") if caption else "" + f"သင်ရငွေ: {amt}")
-            except Exception:
-                pass
+                await context.bot.send_message(target, (caption + "\n") if caption else "" + f"သင်ရငွေ: {amt}",
+                                               rate_limit_args=BACKGROUND)
+            except Exception as e:
+                logger.warning("Balance notification to %s failed: %s", target, e)
         u["awaiting"] = None
+        save_user(user.id)
         await update.message.reply_text("Caption ပို့ပြီးပါပြီ")
         return
 
@@ -526,8 +1494,9 @@ async def photo_message_router(update: Update, context: ContextTypes.DEFAULT_TYP
         file_id = update.message.photo[-1].file_id
         po["screenshot_file_id"] = file_id
         po["step"] = "submitted"
-        MACHINE_ORDERS.append(po.copy())
+        MACHINE_ORDERS.add(po.copy())
         u["pending_order"] = None
+        save_user(user.id)
         await update.message.reply_text("Admin သို့ ပေးပို့ပြီးပါပြီ (pending order list တွင် ထည့်ထားပါသည်)")
         return
 
@@ -535,26 +1504,11 @@ async def photo_message_router(update: Update, context: ContextTypes.DEFAULT_TYP
     if is_admin(user.id) and u.get("awaiting") == "admin_send_withdraw_receipt":
         payload = u.pop("admin_withdraw_payload", None)
         file_id = update.message.photo[-1].file_id
-        if payload:
-            # post to payout channel and notify user
-            try:
-                await context.bot.send_photo(PAYOUT_HISTORY_CHANNEL, file_id, caption=f"order id: {payload['order_id']}, user: {payload['user_id']}, amount: {payload['amount']}, date: {payload['created_at']}")
-            except Exception:
-                pass
-            # deduct balance if available
-            target = payload["user_id"]
-            amt = payload["amount"]
-            if USERS.get(target) and USERS[target]["balance"] >= amt:
-                USERS[target]["balance"] -= amt
-            # remove from queue
-            global WITHDRAW_REQUESTS
-            WITHDRAW_REQUESTS[:] = [r for r in WITHDRAW_REQUESTS if r["order_id"] != payload["order_id"]]
-            try:
-                await context.bot.send_message(target, f"သင့်ငွေထုတ် {amt} ကို ပြီးစီးပါပြီ")
-            except Exception:
-                pass
-            await update.message.reply_text("✅ အောင်မြင်ပါပြီ")
         u["awaiting"] = None
+        save_user(user.id)
+        if payload:
+            await run_on_owner(context.bot, payload["user_id"], "settle_withdraw",
+                               update.effective_chat.id, payload, file_id)
         return
 
     await update.message.reply_text("ပုံကို မလိုအပ်ပါ။")
@@ -563,20 +1517,19 @@ async def photo_message_router(update: Update, context: ContextTypes.DEFAULT_TYP
 # ---------------- MACHINE / CLAIM ----------------
 
 
-async def machines_menu(q, context: ContextTypes.DEFAULT_TYPE):
-    uid = q.from_user.id
-    ensure_user(uid)
+def render_owned(uid: int, page: int = 1):
+    """The machines view (or one page of it) as a single text + keyboard with one Claim button per owned machine."""
     u = USERS[uid]
     now = int(time.time())
-    lines = []
-    
-    await q.message.edit_text("⚙️ စက်များ")
-    
-    for idx in sorted(MACHINES.keys()):
+    nos, page, pages = page_slice(page)
+    owned_blocks = []
+    missing = []
+    buttons = []
+    for idx in nos:
         m = MACHINES[idx]
         owned = None
         for mi in u["machines"]:
-            if mi["machine_no"] == idx and mi["expire_ts"] > now:
+            if mi["machine_no"] == idx:
                 owned = mi
                 break
         mark = "✅" if owned else "❌"
@@ -588,13 +1541,79 @@ async def machines_menu(q, context: ContextTypes.DEFAULT_TYPE):
             per_sec = m["daily_wcoin"] / 86400.0
             pending = int(per_sec * capped)
             line += f"\nExpired: {exp_date}\n({pending} WCoin pending)"
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton("Claim", callback_data=f"claim::{idx}")]])
-            await context.bot.send_message(q.message.chat_id, line, reply_markup=kb)
+            owned_blocks.append(line)
+            buttons.append([InlineKeyboardButton(f"Claim {m['key']}", callback_data=f"claim::{idx}")])
         else:
-            lines.append(line)
-            
-    if lines:
-        await context.bot.send_message(q.message.chat_id, "\n".join(lines))
+            missing.append(line)
+    blocks = ["⚙️ စက်များ"] + owned_blocks
+    if missing:
+        blocks.append("\n".join(missing))
+    if len(u["machines"]) > 1:
+        buttons.append([InlineKeyboardButton("⛏ Claim all", callback_data="claim_all")])
+    bell = "🔔 Claim သတိပေးချက်: ON" if u.get("claim_reminders") else "🔕 Claim သတိပေးချက်: OFF"
+    buttons.append([InlineKeyboardButton(bell, callback_data=f"reminders:{page}")])
+    nav = pager_row("owned", page, pages)
+    if nav:
+        buttons.append(nav)
+    return "\n\n".join(blocks), InlineKeyboardMarkup(buttons) if buttons else None
+
+
+async def machines_menu(q, context: ContextTypes.DEFAULT_TYPE, page: int = 1):
+    uid = q.from_user.id
+    ensure_user(uid)
+    text, kb = render_owned(uid, page)
+    await edit_in_place(q, text, kb)
+
+
+async def toggle_reminders(q, context: ContextTypes.DEFAULT_TYPE, page: int):
+    uid = q.from_user.id
+    u = USERS[uid]
+    u["claim_reminders"] = not u.get("claim_reminders")
+    if u["claim_reminders"]:
+        schedule_reminders(uid, u["machines"])
+    # turning off leaves the queued entries; send_claim_reminders skips them
+    save_user(uid)
+    await machines_menu(q, context, page)
+
+
+def mined_per_claim(machine_no: int) -> int:
+    m = MACHINES[machine_no]
+    return int(m["daily_wcoin"] / 86400.0 * m["claim_interval_sec"])
+
+
+async def handle_claim_all(q, context: ContextTypes.DEFAULT_TYPE):
+    """Claim every ready machine in one pass: one balance change, one reply."""
+    uid = q.from_user.id
+    async with USER_LOCKS(uid):
+        await _claim_all(q, uid)
+
+
+async def _claim_all(q, uid: int):
+    u = USERS[uid]
+    now = int(time.time())
+    claimed = []
+    total = 0
+    soonest = None
+    for mi in u["machines"]:
+        ready = claim_ready_ts(mi)
+        if ready > now:
+            soonest = ready if soonest is None else min(soonest, ready)
+            continue
+        total += mined_per_claim(mi["machine_no"])
+        mi["last_claim_ts"] = now
+        claimed.append(mi)
+    if not claimed:
+        if soonest is None:
+            return await q.answer("⏰ စက်မရှိပါ", show_alert=True)
+        remaining = soonest - now
+        return await q.answer(f"Claim မလုပ်ခင် {remaining//3600} နာရီ {remaining%3600//60} မိနစ် ကျန်ပါသည်", show_alert=True)
+    await q.answer()
+    change_balance(uid, total, CLAIM)
+    if u.get("claim_reminders"):
+        schedule_reminders(uid, claimed)
+    save_user(uid)
+    names = ", ".join(MACHINES[mi["machine_no"]]["key"] for mi in claimed)
+    await q.message.reply_text(f"✅ {names} မှ {total} WCoin ကို Claim လုပ်ပြီး Balance ထဲ ထည့်ပြီးပါပြီ!")
 
 
 async def handle_claim(q, context: ContextTypes.DEFAULT_TYPE, data: str):
@@ -609,13 +1628,18 @@ async def handle_claim(q, context: ContextTypes.DEFAULT_TYPE, data: str):
         await q.answer()
         return
     ensure_user(uid)
+    async with USER_LOCKS(uid):
+        await _claim(q, uid, idx)
+
+
+async def _claim(q, uid: int, idx: int):
     now = int(time.time())
     mi = None
     for m in USERS[uid]["machines"]:
         if m["machine_no"] == idx:
             mi = m
             break
-    if not mi or mi["expire_ts"] <= now:
+    if not mi:
         await q.message.reply_text("⏰ ဒီစက်က Expired ဖြစ်ပြီးသားပါ။")
         return
     elapsed = max(0, now - mi["last_claim_ts"])
@@ -623,10 +1647,12 @@ async def handle_claim(q, context: ContextTypes.DEFAULT_TYPE, data: str):
         remaining = MACHINES[idx]["claim_interval_sec"] - elapsed
         await q.answer(f"Claim မလုပ်ခင် {remaining//3600} နာရီ {remaining%3600//60} မိနစ် ကျန်ပါသည်", show_alert=True)
         return
-    per_sec = MACHINES[idx]["daily_wcoin"] / 86400.0
-    mined = int(per_sec * MACHINES[idx]["claim_interval_sec"])
-    USERS[uid]["balance"] += mined
+    mined = mined_per_claim(idx)
+    change_balance(uid, mined, CLAIM)
     mi["last_claim_ts"] = now
+    if USERS[uid].get("claim_reminders"):
+        schedule_reminders(uid, [mi])
+    save_user(uid)
     await q.message.reply_text(f"✅ {MACHINES[idx]['key']} မှ {mined} WCoin ကို Claim လုပ်ပြီး Balance ထဲ ထည့်ပြီးပါပြီ!")
 
 
@@ -640,6 +1666,7 @@ async def withdraw_menu(q, context: ContextTypes.DEFAULT_TYPE):
     # require withdraw account
     if not u.get("withdraw_account"):
         u["awaiting"] = "withdraw_account"
+        save_user(uid)
         await q.message.reply_text("ငွေထုတ်အကောင့်သတ်မှတ်ရန် - ဖုန်းနံပါတ်တစ်ခု ထည့်ပေးပါ။",
                              reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data="cancel_withdraw")]]))
         return
@@ -669,6 +1696,7 @@ async def prompt_withdraw_account(q, context: ContextTypes.DEFAULT_TYPE):
     uid = q.from_user.id
     u = USERS[uid]
     u["awaiting"] = "withdraw_account"
+    save_user(uid)
     await q.message.reply_text("ဖုန်းနံပါတ် အသစ်ထည့်ပါ", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data="cancel_withdraw")]]))
 
 
@@ -676,6 +1704,7 @@ async def prompt_withdraw_amount(q, context: ContextTypes.DEFAULT_TYPE):
     uid = q.from_user.id
     u = USERS[uid]
     u["awaiting"] = "withdraw_amount"
+    save_user(uid)
     await q.message.reply_text("ထုတ်ယူလိုသည့် ပမာဏအား ထည့်ပါ", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data="cancel_withdraw")]]))
 
 
@@ -691,11 +1720,8 @@ def can_withdraw(user_id: int):
     if u["referrals"] < 10:
         return False, "need_rule2"
     # (3) bought at least one counting machine (Common/Epic/Premium by Wave)
-    now = int(time.time())
     has_buy = False
     for m in u["machines"]:
-        if m["expire_ts"] <= now:
-            continue
         mn = m["machine_no"]
         if mn == 1:
             continue
@@ -722,27 +1748,20 @@ async def cmd_add_b(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(args) != 3:
         return await update.message.reply_text("Usage: /Add_B (username|user_id) (amount) (y|n)")
     who, amt_txt, flag = args
-    # resolve user id
-    target_id = None
-    if who.isdigit():
-        target_id = int(who)
-    else:
-        for uid, u in USERS.items():
-            if u["username"] == who.lstrip("@"):
-                target_id = uid
-                break
-    if not target_id or target_id not in USERS:
+    target_id = resolve_user(who)
+    if not target_id:
         return await update.message.reply_text("User not found")
     try:
         amt = int(amt_txt)
     except Exception:
         return await update.message.reply_text("Invalid amount")
-    USERS[target_id]["balance"] += amt
+    await run_on_owner(context.bot, target_id, "grant", target_id, amt)
     if flag.lower() == "y":
         # ask admin for caption
-        admin_u = USERS[update.effective_user.id]
+        admin_u = ensure_user(update.effective_user.id, update.effective_user.username)
         admin_u["awaiting"] = "admin_add_caption"
         admin_u["admin_add_payload"] = {"target": target_id, "amount": amt}
+        save_user(update.effective_user.id)
         await update.message.reply_text("Caption ပို့ပါ (မထည့်ချင်လျှင် space တစ်ချက်ပဲ ပို့)")
     else:
         await update.message.reply_text("Balance added silently.")
@@ -755,7 +1774,7 @@ async def cmd_wreq(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("No withdraw requests")
     lines = []
     for r in WITHDRAW_REQUESTS:
-        lines.append(f"Order {r['order_id']} - User {r['user_id']} - {r['amount']} - {r['account']}")
+        lines.append(f"Order {r['order_id']} - User {r['user_id']} - {r['amount']} - {r['account']} - {r['status']}")
     await update.message.reply_text("\n".join(lines))
 
 
@@ -768,13 +1787,15 @@ async def cmd_wreq_c(update: Update, context: ContextTypes.DEFAULT_TYPE):
         oid = int(context.args[0])
     except Exception:
         return await update.message.reply_text("Invalid order id")
-    rec = next((r for r in WITHDRAW_REQUESTS if r["order_id"] == oid), None)
+    rec = WITHDRAW_REQUESTS.get(oid)
     if not rec:
         return await update.message.reply_text("Order not found")
+    await run_on_owner(context.bot, rec["user_id"], "withdraw_status", oid, "awaiting_receipt")
     # ask admin to send receipt photo
-    admin_u = USERS[update.effective_user.id]
+    admin_u = ensure_user(update.effective_user.id, update.effective_user.username)
     admin_u["awaiting"] = "admin_send_withdraw_receipt"
     admin_u["admin_withdraw_payload"] = rec
+    save_user(update.effective_user.id)
     await update.message.reply_text("ပြေစာပုံပို့ပေးပါ")
 
 
@@ -798,22 +1819,11 @@ async def cmd_mreq_c(update: Update, context: ContextTypes.DEFAULT_TYPE):
         oid = int(context.args[0])
     except Exception:
         return await update.message.reply_text("Invalid order id")
-    rec = next((r for r in MACHINE_ORDERS if r["order_id"] == oid), None)
+    rec = MACHINE_ORDERS.get(oid)
     if not rec:
         return await update.message.reply_text("Order not found")
     # install machine for user
-    uid = rec["user_id"]
-    if can_buy_machine_now(uid, rec["machine_no"]):
-        install_machine(uid, rec["machine_no"], method="wave")
-        # remove order
-        MACHINE_ORDERS[:] = [r for r in MACHINE_ORDERS if r["order_id"] != oid]
-        try:
-            await context.bot.send_message(uid, f"Order ID {oid} အောင်မြင်ပါပြီ ✅\n{MACHINES[rec['machine_no']]['key']} စက် ပေါင်းထည့်ပြီးပါပြီ။")
-        except Exception:
-            pass
-        await update.message.reply_text("Done")
-    else:
-        await update.message.reply_text("User already owns this machine (active), cannot add.")
+    await run_on_owner(context.bot, rec["user_id"], "approve_machine", update.effective_chat.id, oid)
 
 
 async def cmd_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -822,62 +1832,98 @@ async def cmd_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await update.message.reply_text("Usage: /Skip user_id|username")
     who = context.args[0]
-    target = None
-    if who.isdigit():
-        target = int(who)
-    else:
-        for uid, u in USERS.items():
-            if u["username"] == who.lstrip("@"):
-                target = uid
-                break
-    if not target or target not in USERS:
+    target = resolve_user(who)
+    if not target:
         return await update.message.reply_text("User not found")
-    USERS[target]["skip_verified"] = True
+    await run_on_owner(context.bot, target, "skip", target)
     await update.message.reply_text(f"Skip applied for {who}")
 
 
 async def cmd_total_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("Not admin")
-    await update.message.reply_text(f"Total users: {len(USERS)}")
+    t = COLUMNS.totals(sorted(MACHINES))
+    lines = [f"Total users: {t['users']}",
+             f"Machine owners: {t['owners']}",
+             f"Outstanding balance: {t['liability']} WCoin",
+             f"Daily income of active machines: {t['daily_income']} WCoin"]
+    lines += [f"{no}. {m['key']}: {t[f'machine_{no}']}" for no, m in sorted(MACHINES.items())]
+    await update.message.reply_text("\n".join(lines))
+
+
+async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/Users balance>=100000 machine=4 [page] - users matching every condition."""
+    if not is_admin(update.effective_user.id):
+        return await update.message.reply_text("Not admin")
+    args = list(context.args or [])
+    page = max(1, int(args.pop())) if args and args[-1].isdigit() else 1
+    try:
+        conditions = [parse_condition(a, MACHINES) for a in args]
+    except ValueError as e:
+        return await update.message.reply_text(
+            f"Invalid filter: {e}\nUsage: /Users [balance|referrals|income(>=|<=|>|<|=)N] [machine=N] [page]\n"
+            "machine=0 = no active machine")
+    total, ids = COLUMNS.select(conditions, (page - 1) * USERS_PAGE_SIZE, USERS_PAGE_SIZE)
+    if not total:
+        return await update.message.reply_text("No matching users")
+    pages = -(-total // USERS_PAGE_SIZE)
+    if page > pages:  # past the end: show the last page
+        page = pages
+        _, ids = COLUMNS.select(conditions, (page - 1) * USERS_PAGE_SIZE, USERS_PAGE_SIZE)
+    lines = [f"{uid} @{USERS[uid]['username']} balance={USERS[uid]['balance']}" for uid in ids]
+    lines.append(f"Matching: {total} - Page {page}/{pages}")
+    await update.message.reply_text("\n".join(lines))
 
 
 async def cmd_mowner(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("Not admin")
     if not context.args:
-        return await update.message.reply_text("Usage: /Mowner machine_no")
+        counts = [f"{no}. {m['key']}: {MACHINE_OWNERS.count(no)}" for no, m in sorted(MACHINES.items())]
+        return await update.message.reply_text("Usage: /Mowner machine_no [page]\n\n" + "\n".join(counts))
     try:
         no = int(context.args[0])
     except Exception:
         return await update.message.reply_text("Invalid number")
-    now = int(time.time())
-    owners = []
-    for uid, u in USERS.items():
-        for m in u["machines"]:
-            if m["machine_no"] == no and m["expire_ts"] > now:
-                owners.append((uid, u["username"], u["balance"]))
-                break
-    if not owners:
+    total = MACHINE_OWNERS.count(no)
+    if not total:
         return await update.message.reply_text("No owners")
-    lines = [f"{uid} @{name} balance={bal}" for uid, name, bal in owners]
+    pages = -(-total // OWNER_PAGE_SIZE)
+    page = min(page_arg(context, 1), pages)
+    owners = MACHINE_OWNERS.page(no, (page - 1) * OWNER_PAGE_SIZE, OWNER_PAGE_SIZE)
+    lines = [f"{uid} @{USERS[uid]['username']} balance={USERS[uid]['balance']}" for uid in owners]
+    lines.append(f"Owners: {total} - Page {page}/{pages}")
     await update.message.reply_text("\n".join(lines))
 
 
+def page_arg(context: ContextTypes.DEFAULT_TYPE, pos: int = 0) -> int:
+    """Optional 1-based page number from the command arguments."""
+    try:
+        return max(1, int(context.args[pos]))
+    except (IndexError, TypeError, ValueError):
+        return 1
+
+
+def format_top(board: Leaderboard, page: int) -> str:
+    pages = max(1, -(-len(board) // TOP_PAGE_SIZE))
+    page = min(page, pages)
+    offset = (page - 1) * TOP_PAGE_SIZE
+    lines = [f"{offset+i+1}. @{USERS[uid]['username']} - {score}"
+             for i, (uid, score) in enumerate(board.page(offset, TOP_PAGE_SIZE))]
+    lines.append(f"Page {page}/{pages}")
+    return "\n".join(lines)
+
+
 async def cmd_topb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("Not admin")
-    top = sorted(USERS.items(), key=lambda kv: kv[1]["balance"], reverse=True)[:10]
-    lines = [f"{i+1}. @{u['username']} - {u['balance']}" for i, (uid, u) in enumerate(top)]
-    await update.message.reply_text("\n".join(lines))
+    await update.message.reply_text(format_top(TOP_BALANCE, page_arg(context)))
 
 
 async def cmd_topi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("Not admin")
-    top = sorted(USERS.items(), key=lambda kv: kv[1]["referrals"], reverse=True)[:10]
-    lines = [f"{i+1}. @{u['username']} - {u['referrals']}" for i, (uid, u) in enumerate(top)]
-    await update.message.reply_text("\n".join(lines))
+    await update.message.reply_text(format_top(TOP_REFERRALS, page_arg(context)))
 
 
 async def cmd_about(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -886,19 +1932,11 @@ async def cmd_about(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await update.message.reply_text("Usage: /About user_id|username")
     who = context.args[0]
-    target = None
-    if who.isdigit():
-        target = int(who)
-    else:
-        for uid, u in USERS.items():
-            if u["username"] == who.lstrip("@"):
-                target = uid
-                break
-    if not target or target not in USERS:
+    target = resolve_user(who)
+    if not target:
         return await update.message.reply_text("User not found")
     u = USERS[target]
-    now = int(time.time())
-    machines = [MACHINES[m["machine_no"]]["key"] for m in u["machines"] if m["expire_ts"] > now]
+    machines = [MACHINES[m["machine_no"]]["key"] for m in u["machines"]]
     await update.message.reply_text(
         f"Username: @{u['username']}\nBalance: {u['balance']}\nMachines: {', '.join(machines) or 'None'}\nReferrals: {u['referrals']}"
     )
@@ -911,9 +1949,10 @@ async def cmd_add_img(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("Usage: /Add_img Basic|Common|Epic|Premium")
     name = context.args[0].capitalize()
     # admin will be prompted to upload photo next; we store desired name
-    u = USERS[update.effective_user.id]
+    u = ensure_user(update.effective_user.id, update.effective_user.username)
     u["awaiting"] = "admin_add_img"
     u["admin_img_target"] = name
+    save_user(update.effective_user.id)
     await update.message.reply_text(f"Send photo to set for {name}")
 
 
@@ -921,36 +1960,170 @@ async def cmd_change_img(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return await cmd_add_img(update, context)
 
 
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return await update.message.reply_text("Not admin")
+    await update.message.reply_text(METRICS.format_stats())
+
+
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return await update.message.reply_text("Not admin")
+    msg = update.message
+    arg = context.args[0].lower() if context.args else ""
+    if arg == "stop":
+        if not BROADCASTER.running:
+            return await msg.reply_text("No broadcast running")
+        BROADCASTER.stop()
+        return await msg.reply_text("Stopping broadcast...")
+    if arg == "status" or (not context.args and not msg.reply_to_message):
+        if BROADCASTER.job:
+            return await msg.reply_text(format_progress(BROADCASTER.job))
+        return await msg.reply_text("Usage: /Broadcast text | reply /Broadcast to a message | /Broadcast status|stop")
+    if BROADCASTER.running:
+        return await msg.reply_text("A broadcast is already running (/Broadcast stop)")
+    if msg.reply_to_message:
+        job = new_job(from_chat_id=msg.chat_id, message_id=msg.reply_to_message.message_id)
+    else:
+        # keep the admin's line breaks: context.args has them split away
+        job = new_job(text=msg.text.split(maxsplit=1)[1])
+    status = await msg.reply_text("Broadcast starting...")
+    job["status_chat"] = status.chat_id
+    job["status_message"] = status.message_id
+    start_broadcast(context.application, job)
+
+
+# ---------------- BROADCAST ----------------
+
+
+def start_broadcast(application: Application, job: Dict[str, Any]):
+    """
+    Run (or resume) a broadcast to every user that has not blocked the bot.
+    Recipients are paged by user id from the cursor on, so users who join
+    during the broadcast (with an id past the cursor) are reached too.
+    Stores without an id index (memory, snapshot) page through the ids of
+    USERS sorted once, as a packed array, when the first chunk is taken;
+    users added since are merged in when the walk reaches its end.
+    """
+    if not job["total"]:
+        job["total"] = sum(1 for u in USERS.values() if not u.get("blocked"))
+    snapshot: Dict[str, Any] = {}  # "ids": sorted array of user ids, "seen": len(USERS) when taken
+
+    def page_after(after: int, limit: int) -> List[int]:
+        ids = STORE.user_ids_after(after, limit)
+        if ids is not None:
+            return ids
+        if not snapshot:
+            snapshot.update(ids=array("q", sorted(USERS)), seen=len(USERS))
+        i = bisect_right(snapshot["ids"], after)
+        if i == len(snapshot["ids"]) and len(USERS) > snapshot["seen"]:
+            # USERS keeps insertion order: the newest users are its tail
+            added = islice(reversed(USERS), len(USERS) - snapshot["seen"])
+            snapshot.update(ids=array("q", sorted(uid for uid in added if uid > after)), seen=len(USERS))
+            i = 0
+        return snapshot["ids"][i:i + limit].tolist()
+
+    def recipients(after: int, limit: int) -> List[int]:
+        while True:
+            ids = page_after(after, limit)
+            chunk = [uid for uid in ids if uid in USERS and not USERS[uid].get("blocked")]
+            if chunk or len(ids) < limit:
+                return chunk
+            after = ids[-1]  # a page of blocked users only: keep going
+
+    def on_blocked(uid: int):
+        if owns(uid):
+            USERS[uid]["blocked"] = True
+            save_user(uid)
+        else:
+            sharding.send_op(shard_of(uid), "mark_blocked", (uid,))
+
+    async def on_progress(job: Dict[str, Any]):
+        if not job["status_message"]:
+            return
+        try:
+            await application.bot.edit_message_text(format_progress(job), job["status_chat"], job["status_message"])
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+
+    BROADCASTER.start(application, job, recipients, on_blocked, on_progress)
+
+
 # ---------------- UTIL FUNCTIONS ----------------
 
 
 def active_machines_count(user_id: int) -> int:
-    now = int(time.time())
-    return sum(1 for m in USERS[user_id]["machines"] if m["expire_ts"] > now)
+    return len(USERS[user_id]["machines"])
 
 
 def total_daily_income(user_id: int) -> int:
-    now = int(time.time())
-    s = 0
-    for m in USERS[user_id]["machines"]:
-        if m["expire_ts"] > now:
-            s += MACHINES[m["machine_no"]]["daily_wcoin"]
-    return s
+    return DAILY_INCOME.get(user_id, 0)
 
 
 # ---------------- BOOT ----------------
 
 
-def main():
-    """Start the bot."""
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token(BOT_TOKEN).build()
+async def on_startup(application: Application):
+    global _metrics_server
+    WRITER.start()
+    if METRICS_PORT:
+        port = METRICS_PORT + (SHARD + 1 if SHARDS > 1 else 0)
+        _metrics_server = await metrics.serve(METRICS, METRICS_LISTEN, port)
+    EXPIRY.start(application)
+    REMINDERS.start(application)
+    application.create_task(warm_membership(application))
+    job = BROADCASTER.load_unfinished() if SHARDS <= 1 or SHARD == sharding.COORDINATOR else None
+    if job:
+        logger.info("Resuming broadcast %s after user %s", job["id"], job["cursor"])
+        start_broadcast(application, job)
+
+
+async def suspend_broadcast(application: Application):
+    # before the bot and the outbound limiter shut down; the checkpoint keeps the progress
+    await BROADCASTER.suspend()
+    EXPIRY.stop()
+    REMINDERS.stop()
+    if _metrics_server:
+        await _metrics_server.cleanup()
+
+
+async def close_storage(application: Application):
+    # flush-on-shutdown: nothing queued by the last updates may be lost
+    await WRITER.stop()
+    LEDGER.close()
+    STORE.close()
+
+
+def build_application(builder: Optional[ApplicationBuilder] = None, rate_limiter=None) -> Application:
+    """
+    The Application with every handler registered. main() passes a builder set
+    up for its transport; benchmarks pass one with their own request backend
+    and may swap the outbound limiter (see bench/replay_bench.py).
+    """
+    builder = (
+        (builder or Application.builder())
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_stop(suspend_broadcast)
+        .post_shutdown(close_storage)
+        # different users in parallel, each user's updates in order (see locks.py)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES) if CONCURRENT_UPDATES > 1 else False)
+        .rate_limiter(rate_limiter or OutboundLimiter(SEND_GLOBAL_RATE, SEND_PRIVATE_RATE, SEND_GROUP_RATE,
+                                                      max_retries=SEND_MAX_RETRIES))
+    )
+    application = builder.build()
+
+    if SHARDS > 1 and SHARD == sharding.COORDINATOR:
+        # before metrics.py's group -1 (one handler runs per group)
+        application.add_handler(TypeHandler(Update, refresh_mirror), group=-2)
 
     # public handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CallbackQueryHandler(callback_router))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message_router))
     application.add_handler(MessageHandler(filters.PHOTO, photo_message_router))
+    application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
 
     # admin commands
     application.add_handler(CommandHandler("Add_B", cmd_add_b))
@@ -960,16 +2133,42 @@ def main():
     application.add_handler(CommandHandler("Mreq_C", cmd_mreq_c))
     application.add_handler(CommandHandler("Skip", cmd_skip))
     application.add_handler(CommandHandler("Total_user", cmd_total_user))
+    application.add_handler(CommandHandler("Users", cmd_users))
     application.add_handler(CommandHandler("Mowner", cmd_mowner))
     application.add_handler(CommandHandler("TopB", cmd_topb))
     application.add_handler(CommandHandler("TopI", cmd_topi))
     application.add_handler(CommandHandler("About", cmd_about))
     application.add_handler(CommandHandler("Add_img", cmd_add_img))
     application.add_handler(CommandHandler("Change_img", cmd_change_img))
+    application.add_handler(CommandHandler("Broadcast", cmd_broadcast))
+    application.add_handler(CommandHandler("Stats", cmd_stats))
+    METRICS.install(application, CALLBACK_ACTIONS)
+    return application
+
+
+def main(inbox=None):
+    """Start the bot. `inbox`: run as one process of sharding.py."""
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("Set WCOIN_WEBHOOK_SECRET together with WCOIN_WEBHOOK_URL")
+    if SHARDS > 1 and not (DATABASE_PATH and STORE.shareable):
+        raise RuntimeError("Sharding needs WCOIN_DB on the sqlite backend (shared by all processes)")
+    load_state()
+    builder = Application.builder()
+    if WEBHOOK_URL or inbox is not None:
+        builder = builder.updater(None)  # updates arrive through webhook.py / sharding.py instead
+    if API_URL:
+        builder = builder.base_url(f"{API_URL}/bot").base_file_url(f"{API_URL}/file/bot")
+    application = build_application(builder)
 
     logger.info("Starting bot")
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if inbox is not None:
+        asyncio.run(sharding.serve(application, inbox, run_shard_op))
+    elif WEBHOOK_URL:
+        asyncio.run(webhook.serve(application, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+                                  WEBHOOK_SECRET, max_queue=WEBHOOK_MAX_QUEUE, db_path=DATABASE_PATH))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
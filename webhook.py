@@ -0,0 +1,124 @@
+"""
+Webhook mode for the WCoin bot (v20fix.py), as an alternative to run_polling.
+
+An aiohttp server receives Telegram's POSTs behind a reverse proxy:
+- requests without the configured secret token are rejected (403)
+- each update is decoded, put on the Application's update queue and answered
+  with 200 right away; handlers run afterwards, so Telegram never waits on them
+- when the queue holds more than `max_queue` updates the server answers 503
+  and Telegram redelivers later (back-pressure instead of unbounded memory)
+- SIGTERM / SIGINT: stop accepting, finish in-flight requests, let the
+  Application handle everything already queued, then run the normal shutdown
+  hooks (flush storage etc.)
+
+Run exactly one webhook process per bot. USERS, the order books and the
+per-user locks live in that process's memory: a second replica behind the same
+URL would keep its own diverging copy of every user it is sent, and with a
+shared database the two would overwrite each other's rows (double spends).
+serve() takes an exclusive lock next to the database so a second replica
+refuses to start; to spread load over processes use sharding.py, which routes
+each user to the one process that owns them.
+
+aiohttp is an optional dependency: `pip install aiohttp`.
+"""
+
+import asyncio
+import fcntl
+import hmac
+import json
+import logging
+import signal
+from typing import IO, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+
+def build_web_app(application: Application, path: str, secret_token: str, max_queue: int):
+    from aiohttp import web
+
+    queue = application.update_queue
+    expected = secret_token.encode()
+
+    async def receive(request: "web.Request") -> "web.Response":
+        given = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+        if not hmac.compare_digest(given, expected):
+            return web.Response(status=403)
+        if queue.qsize() >= max_queue:
+            return web.Response(status=503)
+        try:
+            update = Update.de_json(json.loads(await request.read()), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning("Rejected malformed webhook payload: %s", e)
+            return web.Response(status=400)
+        queue.put_nowait(update)
+        return web.Response()
+
+    async def health(request: "web.Request") -> "web.Response":
+        return web.json_response({"queued": queue.qsize()})
+
+    app = web.Application(client_max_size=1024 * 1024)
+    app.router.add_post(path, receive)
+    app.router.add_get("/healthz", health)
+    return app
+
+
+def single_replica_lock(db_path: str) -> IO:
+    """Hold an exclusive lock on `db_path`.lock for the process lifetime; raise if another replica has it."""
+    fh = open(db_path + ".lock", "a")
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fh.close()
+        raise RuntimeError(f"Another webhook replica is serving {db_path}: run one process, "
+                           "or scale out with sharding.py") from None
+    return fh
+
+
+async def serve(application: Application, url: Optional[str], listen: str, port: int, path: str,
+                secret_token: str, max_queue: int = 10000, max_connections: int = 40,
+                db_path: Optional[str] = None):
+    """Run the Application in webhook mode until SIGTERM / SIGINT (one replica, see the module docstring)."""
+    try:
+        from aiohttp import web
+    except ImportError:
+        raise RuntimeError("Webhook mode needs aiohttp: pip install aiohttp") from None
+    lock = single_replica_lock(db_path) if db_path else None
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if url:
+        # the only process serving this bot (state is in memory): all updates must reach it
+        await application.bot.set_webhook(url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES,
+                                          max_connections=max_connections)
+    runner = web.AppRunner(build_web_app(application, path, secret_token, max_queue))
+    await runner.setup()
+    site = web.TCPSite(runner, listen, port)
+    await site.start()
+    await application.start()
+    logger.info("Webhook server listening on %s:%d%s", listen, port, path)
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Draining: closing the listener, then handling %d queued updates",
+                    application.update_queue.qsize())
+        await runner.cleanup()  # stops accepting, waits for in-flight requests
+        await application.stop()  # processes what is queued, waits for handler tasks
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        if lock is not None:
+            lock.close()